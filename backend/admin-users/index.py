@@ -3,11 +3,51 @@ Business: Управление пользователями для админа
 Args: event - HTTP запрос с методами GET/POST/PUT/DELETE и заголовком X-Auth-Token
 Returns: Список пользователей или результат операции
 '''
+import base64
+import hashlib
 import json
 import os
-import psycopg2
+import time
 from datetime import datetime
 
+import db
+import session_cache
+import tracing
+
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 200
+# Входы не поднимают users_revision, поэтому lastLogin в списке устаревает не больше чем на столько секунд
+LIST_LAST_LOGIN_MAX_AGE = int(os.environ.get('LIST_LAST_LOGIN_MAX_AGE', '60'))
+
+MODERATION_ACTIONS = {
+    'block': ('blocked', 'Пользователь заблокирован'),
+    'unblock': ('active', 'Пользователь разблокирован'),
+    'mute': ('muted', 'Пользователь в муте'),
+    'unmute': ('active', 'Мут снят')
+}
+BULK_MAX_IDS = int(os.environ.get('BULK_MAX_IDS', '1000'))
+
+EXPORT_ITERSIZE = int(os.environ.get('EXPORT_ITERSIZE', '2000'))
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8'
+}
+EXPORT_COLUMNS = ['id', 'email', 'name', 'avatar', 'role', 'status', 'provider', 'createdAt', 'lastLogin']
+
+USER_FILTERS = {
+    'status': ('active', 'blocked', 'muted'),
+    'role': ('guest', 'user', 'admin'),
+    'provider': None
+}
+
+# Прогрев при холодном старте, если платформа даёт время на инициализацию до первого запроса
+if os.environ.get('WARMUP_ON_START') == 'true':
+    db.warm_up()
+    if db.REPLICA_URL:
+        db.warm_up(db.REPLICA_URL)
+
+@tracing.trace_handler
+@db.count_round_trips
 def handler(event, context):
     method = event.get('httpMethod', 'GET')
     
@@ -17,7 +57,7 @@ def handler(event, context):
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -33,20 +73,9 @@ def handler(event, context):
             'body': json.dumps({'error': 'Токен не предоставлен'})
         }
     
-    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-    cur = conn.cursor()
+    admin = session_cache.get_identity(token)
     
-    cur.execute("""
-        SELECT u.role FROM users u
-        INNER JOIN sessions s ON u.id = s.user_id
-        WHERE s.token = %s AND s.expires_at > %s
-    """, (token, datetime.now()))
-    
-    admin = cur.fetchone()
-    
-    if not admin or admin[0] != 'admin':
-        cur.close()
-        conn.close()
+    if not admin or admin.role != 'admin':
         return {
             'statusCode': 403,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -54,85 +83,418 @@ def handler(event, context):
         }
     
     if method == 'GET':
-        cur.execute("""
+        query_params = event.get('queryStringParameters') or {}
+        # Только чтение — с реплики, если она задана; транзакция нужна курсору выгрузки
+        with db.read_connection(autocommit=False) as conn, conn.cursor() as cur:
+            if query_params.get('export'):
+                return handle_export(conn, query_params)
+            if query_params.get('stats'):
+                return handle_stats(cur, headers.get('If-None-Match') or headers.get('if-none-match'))
+            return handle_list(cur, query_params, headers.get('If-None-Match') or headers.get('if-none-match'))
+    
+    elif method == 'PUT':
+        body = json.loads(event.get('body', '{}'))
+        with db.connection() as conn, conn.cursor() as cur:
+            return handle_moderation(conn, cur, body, admin.id)
+    
+    else:
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Метод не поддерживается'})
+        }
+
+def user_to_dict(row):
+    return {
+        'id': row[0],
+        'email': row[1],
+        'name': row[2],
+        'avatar': row[3] or '',
+        'role': row[4],
+        'status': row[5],
+        'provider': row[6],
+        'createdAt': row[7].isoformat() if row[7] else None,
+        'lastLogin': row[8].isoformat() if row[8] else None
+    }
+
+def encode_cursor(created_at, user_id):
+    raw = json.dumps([created_at.isoformat(), user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    created_at, user_id = json.loads(raw)
+    return datetime.fromisoformat(created_at), int(user_id)
+
+def build_filters(query_params):
+    conditions = []
+    args = []
+    for field, allowed in USER_FILTERS.items():
+        value = query_params.get(field)
+        if not value:
+            continue
+        # Фильтр модерации приходит из JSON: список или объект psycopg2 передал бы как ARRAY или ROW
+        if not isinstance(value, str) or allowed and value not in allowed:
+            raise ValueError(field)
+        if field == 'provider' and value == 'email':
+            conditions.append('provider IS NULL')
+        else:
+            conditions.append(f'{field} = %s')
+            args.append(value)
+    return conditions, args
+
+def list_etag(revision, query_params):
+    '''Строгий ETag страницы: счётчик изменений users плюс параметры запроса, от которых зависит ответ.'''
+    raw = json.dumps([revision, sorted(query_params.items())])
+    return '"' + hashlib.md5(raw.encode()).hexdigest() + '"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in (tag[2:] if tag.startswith('W/') else tag for tag in candidates)
+
+def handle_list(cur, query_params, if_none_match=None):
+    '''
+    Keyset-пагинация по (created_at, id): страница читается по индексу
+    idx_users_created_id без OFFSET, следующую страницу отдаёт nextCursor.
+    Приблизительное общее количество — только на первой странице. Если users не
+    менялась с прошлого запроса (счётчик users_revision) и не прошло
+    LIST_LAST_LOGIN_MAX_AGE секунд, отдаётся 304 без запросов за страницей.
+    '''
+    try:
+        limit = min(max(int(query_params.get('limit', PAGE_SIZE_DEFAULT)), 1), PAGE_SIZE_MAX)
+        conditions, args = build_filters(query_params)
+        cursor = query_params.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+    except (ValueError, TypeError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Некорректные параметры запроса'})
+        }
+    
+    cur.execute("SELECT revision FROM users_revision")
+    etag = list_etag([cur.fetchone()[0], int(time.time() // LIST_LAST_LOGIN_MAX_AGE)], query_params)
+    response_headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'private, no-cache',
+        'ETag': etag
+    }
+    
+    if etag_matches(if_none_match, etag):
+        return {'statusCode': 304, 'headers': response_headers, 'body': ''}
+    
+    descending = query_params.get('order', 'desc') != 'asc'
+    
+    total = None
+    if after is None:
+        total = estimate_total(cur, query_params, conditions, args)
+    
+    page_conditions = list(conditions)
+    page_args = list(args)
+    if after is not None:
+        page_conditions.append('(created_at, id) < (%s, %s)' if descending else '(created_at, id) > (%s, %s)')
+        page_args.extend(after)
+    where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ''
+    direction = 'DESC' if descending else 'ASC'
+    
+    cur.execute(f"""
+        SELECT id, email, name, avatar_url, role, status, provider, created_at, last_login
+        FROM users
+        {where}
+        ORDER BY created_at {direction}, id {direction}
+        LIMIT %s
+    """, page_args + [limit + 1])
+    
+    rows = cur.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = encode_cursor(last[7], last[0])
+    
+    result = {'users': [user_to_dict(row) for row in rows], 'nextCursor': next_cursor}
+    if total is not None:
+        result['total'] = total
+        result['totalApproximate'] = True
+    
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'body': json.dumps(result)
+    }
+
+def estimate_total(cur, query_params, conditions, args):
+    '''
+    Общее количество без прохода по users. Без фильтров и с одним фильтром
+    оно берётся из user_stats на момент её пересчёта. С несколькими
+    фильтрами это оценка планировщика (Plan Rows).
+    '''
+    filters = [(field, query_params[field]) for field in USER_FILTERS if query_params.get(field)]
+    if len(filters) <= 1:
+        dimension, key = filters[0] if filters else ('total', '')
+        cur.execute("SELECT value FROM user_stats WHERE dimension = %s AND key = %s", (dimension, key))
+        row = cur.fetchone()
+        return row[0] if row else 0
+    
+    cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM users WHERE {' AND '.join(conditions)}", args)
+    return int(cur.fetchone()[0][0]['Plan']['Plan Rows'])
+
+def handle_stats(cur, if_none_match=None):
+    '''
+    Сводка для дашборда из материализованного представления user_stats:
+    одно чтение нескольких десятков строк независимо от числа пользователей.
+    Представление пересчитывает db-maintenance, ETag меняется с каждым пересчётом.
+    '''
+    cur.execute("SELECT dimension, key, value FROM user_stats")
+    rows = cur.fetchall()
+    
+    stats = {'total': 0, 'byStatus': {}, 'byRole': {}, 'byProvider': {},
+             'signupsPerDay': [], 'loginsPerDay': [], 'refreshedAt': None}
+    groups = {'status': 'byStatus', 'role': 'byRole', 'provider': 'byProvider'}
+    series = {'signups': 'signupsPerDay', 'logins': 'loginsPerDay'}
+    refreshed_at = None
+    for dimension, key, value in rows:
+        if dimension == 'total':
+            stats['total'] = value
+        elif dimension in groups:
+            stats[groups[dimension]][key] = value
+        elif dimension in series:
+            stats[series[dimension]].append({'date': key, 'count': value})
+        elif dimension == 'refreshed_at':
+            refreshed_at = value
+            stats['refreshedAt'] = datetime.fromtimestamp(value).isoformat()
+    for name in series.values():
+        stats[name].sort(key=lambda day: day['date'])
+    
+    etag = list_etag(refreshed_at, {'stats': '1'})
+    response_headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'private, no-cache',
+        'ETag': etag
+    }
+    
+    if etag_matches(if_none_match, etag):
+        return {'statusCode': 304, 'headers': response_headers, 'body': ''}
+    
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'body': json.dumps(stats)
+    }
+
+def iter_export_chunks(conn, fmt, conditions, args):
+    '''
+    Читает пользователей серверным (named) курсором пачками по EXPORT_ITERSIZE
+    строк и отдаёт готовые куски NDJSON/CSV, так что в памяти никогда нет
+    больше одной пачки.
+    '''
+    import csv
+    import io
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    with conn.cursor(name='users_export') as cur:
+        cur.itersize = EXPORT_ITERSIZE
+        cur.execute(f"""
             SELECT id, email, name, avatar_url, role, status, provider, created_at, last_login
             FROM users
-            ORDER BY created_at DESC
-        """)
+            {where}
+            ORDER BY id
+        """, args)
         
-        users = []
-        for row in cur.fetchall():
-            users.append({
-                'id': row[0],
-                'email': row[1],
-                'name': row[2],
-                'avatar': row[3] or '',
-                'role': row[4],
-                'status': row[5],
-                'provider': row[6],
-                'createdAt': row[7].isoformat() if row[7] else None,
-                'lastLogin': row[8].isoformat() if row[8] else None
-            })
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS) if fmt == 'csv' else None
+        if writer:
+            writer.writeheader()
         
-        cur.close()
-        conn.close()
+        rows_in_chunk = 0
+        for row in cur:
+            user = user_to_dict(row)
+            if writer:
+                writer.writerow(user)
+            else:
+                buffer.write(json.dumps(user, ensure_ascii=False))
+                buffer.write('\n')
+            rows_in_chunk += 1
+            if rows_in_chunk >= EXPORT_ITERSIZE:
+                yield buffer.getvalue(), rows_in_chunk
+                buffer.seek(0)
+                buffer.truncate()
+                rows_in_chunk = 0
         
+        if buffer.tell():
+            yield buffer.getvalue(), rows_in_chunk
+
+def upload_export(path, fmt):
+    import boto3
+    
+    bucket = os.environ['EXPORT_S3_BUCKET']
+    key = f"exports/users-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    s3 = boto3.client('s3', endpoint_url=os.environ.get('EXPORT_S3_ENDPOINT'))
+    s3.upload_file(path, bucket, key, ExtraArgs={'ContentType': EXPORT_FORMATS[fmt]})
+    return s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=3600)
+
+def handle_export(conn, query_params):
+    fmt = query_params.get('export')
+    target = query_params.get('target', 'body')
+    
+    try:
+        if fmt not in EXPORT_FORMATS or target not in ('body', 'file'):
+            raise ValueError(fmt)
+        conditions, args = build_filters(query_params)
+    except ValueError:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Некорректные параметры запроса'})
+        }
+    
+    # Без бакета файл остался бы внутри контейнера: клиенту от пути толку нет
+    if target == 'file' and not os.environ.get('EXPORT_S3_BUCKET'):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Выгрузка в файл не настроена (EXPORT_S3_BUCKET)'})
+        }
+    
+    chunks = iter_export_chunks(conn, fmt, conditions, args)
+    
+    if target == 'body':
         return {
             'statusCode': 200,
+            'headers': {
+                'Content-Type': EXPORT_FORMATS[fmt],
+                'Content-Disposition': f'attachment; filename="users.{fmt}"',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': ''.join(chunk for chunk, _ in chunks)
+        }
+    
+    import tempfile
+    
+    rows = 0
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            for chunk, count in chunks:
+                f.write(chunk)
+                rows += count
+        result = {'rows': rows, 'bytes': os.path.getsize(path), 'format': fmt,
+                  'url': upload_export(path, fmt)}
+    finally:
+        os.unlink(path)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(result)
+    }
+
+def parse_user_id(value):
+    # bool — подкласс int, а {"userId": true} не должен превратиться в id 1
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError('userId')
+    return int(value)
+
+def handle_moderation(conn, cur, body, admin_id):
+    '''
+    Меняет статус одному пользователю (userId), списку (userIds) или всем,
+    кто подходит под filter, одним UPDATE в одной транзакции. И список, и
+    фильтр ограничены BULK_MAX_IDS пользователями. Себя админ не меняет.
+    '''
+    action = body.get('action')
+    user_ids = body.get('userIds')
+    if user_ids is None and body.get('userId') is not None:
+        user_ids = [body['userId']]
+    user_filter = body.get('filter')
+    
+    if not action or not (user_ids or user_filter):
+        return {
+            'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'users': users, 'total': len(users)})
+            'body': json.dumps({'error': 'userId и action обязательны'})
         }
     
-    elif method == 'PUT':
-        body = json.loads(event.get('body', '{}'))
-        user_id = body.get('userId')
-        action = body.get('action')
-        
-        if not user_id or not action:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'userId и action обязательны'})
-            }
-        
-        if action == 'block':
-            cur.execute("UPDATE users SET status = 'blocked' WHERE id = %s", (user_id,))
-            message = 'Пользователь заблокирован'
-        elif action == 'unblock':
-            cur.execute("UPDATE users SET status = 'active' WHERE id = %s", (user_id,))
-            message = 'Пользователь разблокирован'
-        elif action == 'mute':
-            cur.execute("UPDATE users SET status = 'muted' WHERE id = %s", (user_id,))
-            message = 'Пользователь в муте'
-        elif action == 'unmute':
-            cur.execute("UPDATE users SET status = 'active' WHERE id = %s", (user_id,))
-            message = 'Мут снят'
+    if action not in MODERATION_ACTIONS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Неизвестное действие'})
+        }
+    
+    new_status, message = MODERATION_ACTIONS[action]
+    
+    try:
+        if user_ids:
+            # Строка или словарь перебирались бы по символам и ключам: "42" -> id 4 и 2
+            if not isinstance(user_ids, list) or len(user_ids) > BULK_MAX_IDS:
+                raise ValueError('userIds')
+            user_ids = [parse_user_id(user_id) for user_id in user_ids]
+            conditions, args = ['id = ANY(%s)'], [user_ids]
         else:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Неизвестное действие'})
-            }
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        
+            conditions, args = build_filters(user_filter)
+            if not conditions:
+                raise ValueError('filter')
+    except (ValueError, TypeError, AttributeError):
         return {
-            'statusCode': 200,
+            'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': True, 'message': message})
+            'body': json.dumps({'error': 'Некорректные параметры запроса'})
         }
     
-    else:
-        cur.close()
-        conn.close()
+    # Лишняя строка в target значит, что фильтр шире лимита: тогда UPDATE ничего не меняет
+    cur.execute(f"""
+        WITH target AS (
+            SELECT id, status FROM users
+            WHERE {' AND '.join(conditions)} AND id <> %s
+            LIMIT %s
+            FOR UPDATE
+        ), updated AS (
+            UPDATE users u SET status = %s
+            FROM target t
+            WHERE u.id = t.id AND t.status <> %s
+              AND (SELECT count(*) FROM target) <= %s
+            RETURNING u.id
+        )
+        SELECT t.id, updated.id IS NOT NULL
+        FROM target t
+        LEFT JOIN updated ON updated.id = t.id
+    """, args + [admin_id, BULK_MAX_IDS + 1, new_status, new_status, BULK_MAX_IDS])
+    
+    rows = cur.fetchall()
+    if len(rows) > BULK_MAX_IDS:
+        conn.rollback()
         return {
-            'statusCode': 405,
+            'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'})
+            'body': json.dumps({'error': f'Под фильтр попадает больше {BULK_MAX_IDS} пользователей'})
         }
+    
+    results = {row[0]: 'updated' if row[1] else 'unchanged' for row in rows}
+    conn.commit()
+    # Список, который админ запросит следом, должен уже показать новые статусы
+    db.note_write()
+    
+    affected = [user_id for user_id, result in results.items() if result == 'updated']
+    session_cache.invalidate_users(affected)
+    
+    for user_id in user_ids or []:
+        results.setdefault(user_id, 'forbidden' if user_id == admin_id else 'not_found')
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'message': message,
+            'affected': len(affected),
+            'results': [{'id': user_id, 'result': result} for user_id, result in results.items()]
+        })
+    }
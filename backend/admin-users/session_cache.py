@@ -0,0 +1,210 @@
+'''
+Business: Кэш сессий по токену внутри тёплого контейнера (LRU + TTL, в том числе отрицательный)
+Args: SESSION_CACHE_SIZE, SESSION_CACHE_TTL, SESSION_CACHE_NEGATIVE_TTL, SESSION_CACHE_REVISION_CHECK из окружения
+Returns: Пользователь сессии через get_user(token) или None для неизвестного/истёкшего токена
+'''
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+import db
+import signed_tokens
+
+CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '30'))
+CACHE_NEGATIVE_TTL = float(os.environ.get('SESSION_CACHE_NEGATIVE_TTL', '10'))
+# Как часто сверять auth_revision: блокировки и смены ролей из других функций видны не позже
+REVISION_CHECK_SECONDS = float(os.environ.get('SESSION_CACHE_REVISION_CHECK', '5'))
+
+SessionUser = namedtuple('SessionUser', 'id email name avatar_url role status provider created_at updated_at')
+Identity = namedtuple('Identity', 'id role')
+
+SESSION_USER_SQL = db.Statement('session_user', """
+    SELECT u.id, u.email, u.name, u.avatar_url, u.role, u.status, u.provider, u.created_at,
+           u.updated_at, s.expires_at
+    FROM users u
+    INNER JOIN sessions s ON u.id = s.user_id
+    WHERE s.token_hash = md5(%s)::uuid AND s.expires_at > %s
+""")
+
+USER_BY_ID_SQL = db.Statement('user_by_id', """
+    SELECT id, email, name, avatar_url, role, status, provider, created_at, updated_at
+    FROM users
+    WHERE id = %s
+""")
+
+
+class SessionCache:
+    '''
+    Хранит и найденных пользователей, и отсутствующие токены (значение None),
+    чтобы поток поддельных токенов не доходил до базы. Запись никогда не живёт
+    дольше expires_at самой сессии.
+    '''
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0,
+                      'revision_clears': 0}
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+            user, deadline = entry
+            if time.monotonic() >= deadline:
+                del self._entries[token]
+                self.stats['misses'] += 1
+                return False, None
+            self._entries.move_to_end(token)
+            self.stats['hits' if user else 'negative_hits'] += 1
+            return True, user
+
+    def put(self, token, user, expires_at=None):
+        ttl = self.ttl if user else self.negative_ttl
+        if expires_at is not None:
+            ttl = min(ttl, (expires_at - datetime.now()).total_seconds())
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (user, time.monotonic() + ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate_token(self, token):
+        with self._lock:
+            if self._entries.pop(token, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def invalidate_users(self, user_ids):
+        user_ids = {str(user_id) for user_id in user_ids}
+        with self._lock:
+            stale = [token for token, (user, _) in self._entries.items()
+                     if user and str(user.id) in user_ids]
+            for token in stale:
+                del self._entries[token]
+            self.stats['invalidations'] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = SessionCache()
+_revision = {'value': None, 'checked_at': 0.0}
+_revision_lock = threading.Lock()
+
+
+def _sync_revision():
+    '''
+    invalidate_users() чистит кэш только своего контейнера. Блокировку или
+    смену роли в admin-users остальные контейнеры видят по счётчику
+    auth_revision (его поднимают триггеры users и sessions): если он
+    изменился, кэш сбрасывается целиком. Счётчик читается не чаще раза
+    в REVISION_CHECK_SECONDS.
+    '''
+    if time.monotonic() - _revision['checked_at'] < REVISION_CHECK_SECONDS:
+        return
+    with _revision_lock:
+        if time.monotonic() - _revision['checked_at'] < REVISION_CHECK_SECONDS:
+            return
+        with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+            cur.execute("SELECT revision FROM auth_revision")
+            row = cur.fetchone()
+        revision = row[0] if row else 0
+        if _revision['value'] is not None and revision != _revision['value']:
+            _cache.clear()
+            _cache.stats['revision_clears'] += 1
+        _revision['value'] = revision
+        _revision['checked_at'] = time.monotonic()
+
+
+def get_user(token):
+    _sync_revision()
+    if signed_tokens.is_signed(token):
+        return _get_signed_user(token)
+
+    hit, user = _cache.get(token)
+    if hit:
+        return user
+
+    row = _fetch_one(SESSION_USER_SQL, (token, datetime.now()))
+
+    if not row:
+        _cache.put(token, None)
+        return None
+
+    user = SessionUser(*row[:-1])
+    _cache.put(token, user, expires_at=row[-1])
+    return user
+
+
+def _get_signed_user(token):
+    # Подпись и отзыв проверяются на каждом запросе, кэш хранит только профиль
+    claims = signed_tokens.verify(token)
+    if not claims:
+        return None
+
+    hit, user = _cache.get(token)
+    if hit:
+        return user
+
+    # Токен, выданный только что, читается из основной БД: на реплику ещё
+    # могли не дойти сам пользователь или его подтверждение в handle_verify
+    row = _fetch_one(USER_BY_ID_SQL, (claims['uid'],), written_at=claims['iat'])
+
+    user = SessionUser(*row) if row else None
+    _cache.put(token, user, expires_at=datetime.fromtimestamp(claims['exp']))
+    return user
+
+
+def _fetch_one(statement, args, written_at=None):
+    '''
+    Строка с реплики, если она задана. Промах реплики перепроверяется в
+    основной БД: непрозрачный токен не знает времени выдачи, а сессия из
+    handle_login/handle_verify могла до реплики ещё не дойти.
+    '''
+    with db.read_connection(written_at) as conn, conn.cursor() as cur:
+        cur.execute(statement, args)
+        row = cur.fetchone()
+        replica = conn.replica
+
+    if row is None and replica:
+        with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+            cur.execute(statement, args)
+            row = cur.fetchone()
+    return row
+
+
+def get_identity(token):
+    '''
+    Только id и роль. Для подписанных токенов берутся из claims без
+    обращения к БД, для непрозрачных — через get_user().
+    '''
+    if signed_tokens.is_signed(token):
+        claims = signed_tokens.verify(token)
+        return Identity(claims['uid'], claims['role']) if claims else None
+
+    user = get_user(token)
+    return Identity(user.id, user.role) if user else None
+
+
+def invalidate_users(user_ids):
+    _cache.invalidate_users(user_ids)
+
+
+def invalidate_token(token):
+    _cache.invalidate_token(token)
+
+
+def cache_stats():
+    return dict(_cache.stats, size=len(_cache._entries))
@@ -0,0 +1,203 @@
+'''
+Business: Общий HTTP-клиент для внешних сервисов (reCAPTCHA, OAuth-провайдеры)
+Args: HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, HTTP_POOL_SIZE, CIRCUIT_* из окружения
+Returns: Ответ requests через request()/get()/post() и метрики по апстримам через upstream_stats()
+'''
+import os
+import threading
+import time
+
+import tracing
+
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3'))
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '5'))
+RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', '30'))
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    '''
+    После threshold подряд неудачных вызовов апстрим считается недоступным
+    на reset_timeout секунд: вызовы сразу получают UpstreamUnavailable.
+    Затем пропускается один пробный вызов, его результат закрывает
+    или снова открывает цепь.
+    '''
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.errors = 0
+        self.rejected = 0
+
+    def observe(self, elapsed_ms):
+        index = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                index = i
+                break
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+
+    def snapshot(self):
+        labels = [f'le_{bound}' for bound in LATENCY_BUCKETS_MS] + ['le_inf']
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total_ms / self.count, 2) if self.count else 0,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'buckets': dict(zip(labels, self.buckets))
+        }
+
+
+def _build_session():
+    # requests и urllib3 — самая тяжёлая часть импорта функции (~100 мс), поэтому
+    # они загружаются при первом внешнем вызове, а не при холодном старте
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=0,
+        status=1,
+        status_forcelist=(502, 503, 504),
+        backoff_factor=0.1,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+_breakers = {}
+_histograms = {}
+_registry_lock = threading.Lock()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def warm_up():
+    '''Заранее импортирует requests и создаёт сессию, если платформа даёт время на прогрев.'''
+    _get_session()
+
+
+def _upstream(name):
+    if name not in _breakers:
+        with _registry_lock:
+            if name not in _breakers:
+                _histograms[name] = LatencyHistogram()
+                _breakers[name] = CircuitBreaker()
+    return _breakers[name], _histograms[name]
+
+
+def request(method, url, upstream, timeout=None, **kwargs):
+    '''
+    Выполняет запрос через общий keep-alive пул. Ошибки сети, таймауты и 5xx
+    засчитываются в circuit breaker апстрима upstream и превращаются
+    в UpstreamUnavailable; ответы 4xx возвращаются как есть.
+    '''
+    breaker, histogram = _upstream(upstream)
+    if not breaker.allow():
+        histogram.rejected += 1
+        raise UpstreamUnavailable(f'{upstream}: circuit open')
+
+    session = _get_session()
+    import requests
+
+    started = time.perf_counter()
+    with tracing.span('http-' + upstream, tracing.KIND_CLIENT) as span:
+        span.set('http.method', method)
+        span.set('url.full', url.split('?', 1)[0])
+        try:
+            response = session.request(method, url, timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+        except requests.RequestException as e:
+            histogram.observe((time.perf_counter() - started) * 1000)
+            histogram.errors += 1
+            breaker.record_failure()
+            raise UpstreamUnavailable(f'{upstream}: {e}') from e
+        span.set('http.status_code', response.status_code)
+
+    histogram.observe((time.perf_counter() - started) * 1000)
+    if response.status_code >= 500:
+        histogram.errors += 1
+        breaker.record_failure()
+        raise UpstreamUnavailable(f'{upstream}: HTTP {response.status_code}')
+
+    breaker.record_success()
+    return response
+
+
+def get(url, upstream, **kwargs):
+    return request('GET', url, upstream, **kwargs)
+
+
+def post(url, upstream, **kwargs):
+    return request('POST', url, upstream, **kwargs)
+
+
+def upstream_stats():
+    return {name: dict(_histograms[name].snapshot(), circuit=_breakers[name].state)
+            for name in list(_breakers)}
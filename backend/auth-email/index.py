@@ -5,18 +5,53 @@ Returns: Success/error с токеном или кодом подтвержде
 '''
 import json
 import os
-import psycopg2
-import requests
-import hashlib
 import secrets
 from datetime import datetime, timedelta
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
+import db
+import http_client
+import signed_tokens
+import passwords
+import last_login
+import rate_limit
+import tracing
+
+RECAPTCHA_VERIFY_URL = os.environ.get('RECAPTCHA_VERIFY_URL', 'https://www.google.com/recaptcha/api/siteverify')
+VERIFY_MAX_ATTEMPTS = int(os.environ.get('VERIFY_MAX_ATTEMPTS', '5'))
+
+# Запросы входа выполняются на каждом логине, поэтому готовятся на соединении один раз
+LOGIN_USER_SQL = db.Statement('login_user', """
+    SELECT id, role, status, email_verified, password_hash FROM users
+    WHERE email = %s
+""")
+
+if last_login.deferred():
+    # users трогаем только ради пересохранения хэша, время входа пишется отложенно
+    TOUCH_USER_SQL = "UPDATE users SET password_hash = %(hash)s WHERE id = %(user_id)s AND %(hash)s::varchar IS NOT NULL"
+else:
+    TOUCH_USER_SQL = "UPDATE users SET last_login = %(now)s, password_hash = COALESCE(%(hash)s, password_hash) WHERE id = %(user_id)s"
+
+# last_login, пересохранение хэша и сессия — один запрос
+LOGIN_SESSION_SQL = db.Statement('login_session', f"""
+    WITH touched AS ({TOUCH_USER_SQL}){last_login.event_cte()}
+    INSERT INTO sessions (user_id, token_hash, expires_at)
+    VALUES (%(user_id)s, md5(%(token)s)::uuid, %(expires_at)s)
+""")
+
+# Прогрев при холодном старте, если платформа даёт время на инициализацию до первого запроса
+if os.environ.get('WARMUP_ON_START') == 'true':
+    db.warm_up()
+    http_client.warm_up()
+    passwords.calibrate()
+
+@tracing.trace_handler
+@db.count_round_trips
 def handler(event, context):
     method = event.get('httpMethod', 'POST')
     
+    # Отложенные last_login сбрасываются на любом вызове, а не только на следующем входе
+    last_login.flush_if_due()
+    
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
@@ -39,58 +74,58 @@ def handler(event, context):
     body = json.loads(event.get('body', '{}'))
     action = body.get('action')
     
-    if action == 'register':
-        return handle_register(body, context)
-    elif action == 'verify':
-        return handle_verify(body, context)
-    elif action == 'login':
-        return handle_login(body, context)
-    else:
+    # Отсекаем всплески до reCAPTCHA, хэширования пароля и запросов к БД
+    if action in ('register', 'login'):
+        limited = rate_limit.check(action, client_ip(event), body.get('email'))
+        if limited:
+            scope, retry_after = limited
+            return {
+                'statusCode': 429,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*',
+                    'Retry-After': str(retry_after)
+                },
+                'body': json.dumps({'error': 'Слишком много попыток, попробуйте позже'})
+            }
+    
+    try:
+        if action == 'register':
+            return handle_register(body, context)
+        elif action == 'verify':
+            return handle_verify(body, context)
+        elif action == 'login':
+            return handle_login(body, context)
+        else:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Неизвестное действие'})
+            }
+    except http_client.UpstreamUnavailable:
         return {
-            'statusCode': 400,
+            'statusCode': 503,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Неизвестное действие'})
+            'body': json.dumps({'error': 'Внешний сервис временно недоступен'})
         }
 
+def client_ip(event):
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    if identity.get('sourceIp'):
+        return identity['sourceIp']
+    headers = event.get('headers') or {}
+    forwarded = headers.get('X-Forwarded-For') or headers.get('x-forwarded-for')
+    return forwarded.split(',')[0].strip() if forwarded else None
+
 def verify_recaptcha(token):
     secret = os.environ.get('RECAPTCHA_SECRET_KEY')
-    response = requests.post('https://www.google.com/recaptcha/api/siteverify', data={
+    response = http_client.post(RECAPTCHA_VERIFY_URL, 'recaptcha', data={
         'secret': secret,
         'response': token
     })
     result = response.json()
     return result.get('success', False) and result.get('score', 0) >= 0.5
 
-def send_verification_email(email, code):
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-    
-    msg = MIMEMultipart()
-    msg['From'] = smtp_user
-    msg['To'] = email
-    msg['Subject'] = 'Код подтверждения PozLite Studio'
-    
-    body = f'''
-    <html>
-        <body>
-            <h2>Добро пожаловать в PozLite Studio!</h2>
-            <p>Ваш код подтверждения:</p>
-            <h1 style="color: #8B5CF6; font-size: 32px;">{code}</h1>
-            <p>Код действителен 5 минут.</p>
-        </body>
-    </html>
-    '''
-    
-    msg.attach(MIMEText(body, 'html'))
-    
-    server = smtplib.SMTP(smtp_host, smtp_port)
-    server.starttls()
-    server.login(smtp_user, smtp_password)
-    server.send_message(msg)
-    server.quit()
-
 def handle_register(body, context):
     email = body.get('email')
     password = body.get('password')
@@ -118,13 +153,11 @@ def handle_register(body, context):
             'body': json.dumps({'error': 'reCAPTCHA проверка не пройдена'})
         }
     
-    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-    cur = conn.cursor()
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        cur.execute("SELECT email_verified FROM users WHERE email = %s", (email,))
+        existing = cur.fetchone()
     
-    cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-    if cur.fetchone():
-        cur.close()
-        conn.close()
+    if existing and existing[0]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -132,25 +165,35 @@ def handle_register(body, context):
         }
     
     code = ''.join([str(secrets.randbelow(10)) for _ in range(6)])
-    expires_at = datetime.now() + timedelta(minutes=5)
-    
-    cur.execute("""
-        INSERT INTO email_verifications (email, code, expires_at)
-        VALUES (%s, %s, %s)
-    """, (email, code, expires_at))
-    
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
-    
-    cur.execute("""
-        INSERT INTO users (email, name, password_hash, role, email_verified)
-        VALUES (%s, %s, %s, 'user', FALSE)
-    """, (email, name, password_hash))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
-    send_verification_email(email, code)
+    now = datetime.now()
+    
+    # Повторная регистрация неподтверждённого email только заменяет код:
+    # пароль остаётся прежним, иначе его мог бы подменить посторонний
+    create_user = ''
+    password_hash = None
+    if not existing:
+        # KDF (~50 мс) считается до соединения с БД: оно не простаивает в транзакции
+        password_hash = passwords.hash_password(password)
+        create_user = """, created AS (
+            INSERT INTO users (email, name, password_hash, role, email_verified)
+            VALUES (%(email)s, %(name)s, %(password_hash)s, 'user', FALSE)
+            ON CONFLICT (email) DO NOTHING
+        )"""
+    
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        # Код (одна строка на email), письмо в очередь и пользователь — один запрос
+        cur.execute(f"""
+            WITH code AS (
+                INSERT INTO email_verifications (email, code, expires_at, attempts, created_at)
+                VALUES (%(email)s, %(code)s, %(expires_at)s, 0, %(now)s)
+                ON CONFLICT (email) DO UPDATE
+                SET code = EXCLUDED.code, expires_at = EXCLUDED.expires_at,
+                    attempts = 0, created_at = EXCLUDED.created_at
+            ){create_user}
+            INSERT INTO email_outbox (recipient, template, payload)
+            VALUES (%(email)s, 'verification', %(payload)s)
+        """, {'email': email, 'code': code, 'now': now, 'expires_at': now + timedelta(minutes=5),
+              'name': name, 'password_hash': password_hash, 'payload': json.dumps({'code': code})})
     
     return {
         'statusCode': 200,
@@ -173,32 +216,60 @@ def handle_verify(body, context):
             'body': json.dumps({'error': 'Email и код обязательны'})
         }
     
-    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT code, expires_at FROM email_verifications
-        WHERE email = %s
-        ORDER BY created_at DESC
-        LIMIT 1
-    """, (email,))
-    
-    result = cur.fetchone()
-    
-    if not result:
-        cur.close()
-        conn.close()
+    now = datetime.now()
+    session_token = signed_tokens.new_session_token()
+    token_expires = now + timedelta(days=30)
+    
+    # Проверка кода по первичному ключу, учёт попыток, погашение кода,
+    # подтверждение email и создание сессии — один запрос. FOR UPDATE
+    # упорядочивает параллельные попытки, чтобы счётчик не обходился.
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        cur.execute("""
+            WITH pending AS (
+                SELECT code, expires_at, attempts FROM email_verifications
+                WHERE email = %(email)s
+                FOR UPDATE
+            ), matched AS (
+                SELECT 1 FROM pending
+                WHERE code = %(code)s AND expires_at >= %(now)s AND attempts < %(max_attempts)s
+            ), consumed AS (
+                DELETE FROM email_verifications
+                WHERE email = %(email)s AND EXISTS (SELECT 1 FROM matched)
+            ), failed AS (
+                UPDATE email_verifications SET attempts = attempts + 1
+                WHERE email = %(email)s AND NOT EXISTS (SELECT 1 FROM matched)
+            ), verified AS (
+                UPDATE users SET email_verified = TRUE, last_login = %(now)s
+                WHERE email = %(email)s AND EXISTS (SELECT 1 FROM matched)
+                RETURNING id, role
+            ), session AS (
+                INSERT INTO sessions (user_id, token_hash, expires_at)
+                SELECT id, md5(%(token)s)::uuid, %(token_expires)s FROM verified
+            )
+            SELECT pending.code, pending.expires_at, pending.attempts, verified.id, verified.role
+            FROM (SELECT 1) AS one
+            LEFT JOIN pending ON TRUE
+            LEFT JOIN verified ON TRUE
+        """, {'email': email, 'code': code, 'now': now, 'max_attempts': VERIFY_MAX_ATTEMPTS,
+              'token': session_token, 'token_expires': token_expires})
+        
+        stored_code, expires_at, attempts, user_id, role = cur.fetchone()
+    
+    if stored_code is None:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Код не найден'})
         }
     
-    stored_code, expires_at = result
+    if attempts >= VERIFY_MAX_ATTEMPTS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Превышено число попыток, запросите новый код'})
+        }
     
-    if datetime.now() > expires_at:
-        cur.close()
-        conn.close()
+    if now > expires_at:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -206,44 +277,20 @@ def handle_verify(body, context):
         }
     
     if code != stored_code:
-        cur.close()
-        conn.close()
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Неверный код'})
         }
     
-    cur.execute("""
-        UPDATE users SET email_verified = TRUE, last_login = %s
-        WHERE email = %s
-        RETURNING id, role
-    """, (datetime.now(), email))
-    
-    user_data = cur.fetchone()
-    
-    if not user_data:
-        cur.close()
-        conn.close()
+    if user_id is None:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Пользователь не найден'})
         }
     
-    user_id, role = user_data
-    
-    token = secrets.token_urlsafe(32)
-    token_expires = datetime.now() + timedelta(days=30)
-    
-    cur.execute("""
-        INSERT INTO sessions (user_id, token, expires_at)
-        VALUES (%s, %s, %s)
-    """, (user_id, token, token_expires))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+    token = signed_tokens.issue(session_token, user_id, role, token_expires)
     
     return {
         'statusCode': 200,
@@ -273,32 +320,23 @@ def handle_login(body, context):
             'body': json.dumps({'error': 'reCAPTCHA проверка не пройдена'})
         }
     
-    password_hash = hashlib.sha256(password.encode()).hexdigest()
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        cur.execute(LOGIN_USER_SQL, (email,))
+        user = cur.fetchone()
     
-    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-    cur = conn.cursor()
+    # KDF (~50 мс) и перехэширование — без соединения из пула, его берём заново для записи
+    password_ok, needs_rehash = passwords.verify_password(password, user[4] if user else None)
     
-    cur.execute("""
-        SELECT id, role, status, email_verified FROM users
-        WHERE email = %s AND password_hash = %s
-    """, (email, password_hash))
-    
-    user = cur.fetchone()
-    
-    if not user:
-        cur.close()
-        conn.close()
+    if not password_ok:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Неверный email или пароль'})
         }
     
-    user_id, role, status, email_verified = user
+    user_id, role, status, email_verified, _ = user
     
     if status == 'blocked':
-        cur.close()
-        conn.close()
         return {
             'statusCode': 403,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -306,29 +344,24 @@ def handle_login(body, context):
         }
     
     if not email_verified:
-        cur.close()
-        conn.close()
         return {
             'statusCode': 403,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Email не подтверждён'})
         }
     
-    cur.execute("""
-        UPDATE users SET last_login = %s WHERE id = %s
-    """, (datetime.now(), user_id))
-    
-    token = secrets.token_urlsafe(32)
+    new_hash = passwords.hash_password(password) if needs_rehash else None
+    session_token = signed_tokens.new_session_token()
     token_expires = datetime.now() + timedelta(days=30)
     
-    cur.execute("""
-        INSERT INTO sessions (user_id, token, expires_at)
-        VALUES (%s, %s, %s)
-    """, (user_id, token, token_expires))
+    logged_in_at = datetime.now()
+    
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        cur.execute(LOGIN_SESSION_SQL, {'now': logged_in_at, 'hash': new_hash, 'user_id': user_id,
+                                        'token': session_token, 'expires_at': token_expires})
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    last_login.touch(user_id, logged_in_at)
+    token = signed_tokens.issue(session_token, user_id, role, token_expires)
     
     return {
         'statusCode': 200,
@@ -0,0 +1,102 @@
+'''
+Business: Отложенная (write-behind) запись users.last_login вместо UPDATE на каждый вход
+Args: LAST_LOGIN_MODE (sync/buffer/table), LAST_LOGIN_FLUSH_INTERVAL из окружения
+Returns: Признак отложенного режима через deferred() и сброс буфера через flush() и flush_if_due()
+'''
+import atexit
+import os
+import threading
+import time
+
+import db
+
+MODE = os.environ.get('LAST_LOGIN_MODE', 'sync')
+FLUSH_INTERVAL = float(os.environ.get('LAST_LOGIN_FLUSH_INTERVAL', '60'))
+
+# Режимы:
+#   sync   — last_login обновляется в том же запросе, что создаёт сессию (как раньше);
+#   buffer — время входа копится в памяти тёплого контейнера и сбрасывается одним
+#            UPDATE ... FROM (VALUES ...), когда буфер старше LAST_LOGIN_FLUSH_INTERVAL
+#            секунд. Проверка идёт на каждом вызове auth-email/auth-oauth, а в шлюзе ещё
+#            и фоновым потоком раз в секунду. Поэтому задержка ограничена только там,
+#            где процесс живёт постоянно. Замороженный или убитый платформой контейнер
+#            не сбросит буфер до следующего вызова или вовсе. Для облачных функций
+#            подходит table;
+#   table  — вход дописывается в login_events, а функция db-maintenance переносит
+#            последние значения в users; задержка ограничена периодом её таймера.
+
+_pending = {}
+_pending_since = None
+_lock = threading.Lock()
+
+
+def deferred():
+    return MODE in ('buffer', 'table')
+
+
+def event_cte(source=None):
+    '''
+    Дополнительная CTE для запроса входа: в режиме table дописывает строку в
+    login_events. Ожидает именованные параметры %(user_id)s и %(now)s или, если
+    задан source, берёт id незаблокированных пользователей из этой CTE.
+    '''
+    if MODE != 'table':
+        return ''
+    if source:
+        return (f", logged AS (INSERT INTO login_events (user_id, logged_in_at) "
+                f"SELECT id, %(now)s FROM {source} WHERE status <> 'blocked')")
+    return ", logged AS (INSERT INTO login_events (user_id, logged_in_at) VALUES (%(user_id)s, %(now)s))"
+
+
+def touch(user_id, logged_in_at):
+    '''Запоминает вход в режиме buffer и сбрасывает буфер, если он старше FLUSH_INTERVAL.'''
+    global _pending_since
+    if MODE != 'buffer':
+        return
+    with _lock:
+        previous = _pending.get(user_id)
+        if previous is None or previous < logged_in_at:
+            _pending[user_id] = logged_in_at
+        if _pending_since is None:
+            _pending_since = time.monotonic()
+    flush_if_due()
+
+
+def flush_if_due():
+    '''Сбрасывает буфер, если он старше FLUSH_INTERVAL; без буфера ничего не делает.'''
+    if MODE != 'buffer':
+        return 0
+    with _lock:
+        due = _pending_since is not None and time.monotonic() - _pending_since >= FLUSH_INTERVAL
+    return flush() if due else 0
+
+
+def flush():
+    global _pending, _pending_since
+    with _lock:
+        batch, since, _pending, _pending_since = _pending, _pending_since, {}, None
+    if not batch:
+        return 0
+
+    from psycopg2.extras import execute_values
+
+    try:
+        with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+            execute_values(cur, """
+                UPDATE users u SET last_login = v.logged_in_at
+                FROM (VALUES %s) AS v(id, logged_in_at)
+                WHERE u.id = v.id AND (u.last_login IS NULL OR u.last_login < v.logged_in_at)
+            """, list(batch.items()), template='(%s, %s::timestamp)', page_size=len(batch))
+    except Exception:
+        # Пачка возвращается в буфер с прежним возрастом, чтобы следующий сброс её повторил
+        with _lock:
+            for user_id, logged_in_at in batch.items():
+                current = _pending.get(user_id)
+                if current is None or current < logged_in_at:
+                    _pending[user_id] = logged_in_at
+            _pending_since = since if _pending_since is None else min(since, _pending_since)
+        raise
+    return len(batch)
+
+
+atexit.register(flush)
@@ -0,0 +1,171 @@
+'''
+Business: Хэширование паролей с версионированным форматом и калибровкой стоимости под целевую задержку
+Args: PASSWORD_HASH_SCHEME, PASSWORD_HASH_TARGET_MS, PASSWORD_HASH_PROCESSES из окружения
+Returns: Строку хэша через hash_password() и результат проверки через verify_password()
+'''
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+import tracing
+
+HASH_SCHEME = os.environ.get('PASSWORD_HASH_SCHEME', 'pbkdf2-sha256')
+TARGET_MS = float(os.environ.get('PASSWORD_HASH_TARGET_MS', '50'))
+HASH_PROCESSES = int(os.environ.get('PASSWORD_HASH_PROCESSES', '0'))
+SALT_BYTES = 16
+
+
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _unb64(value):
+    return base64.b64decode(value + '=' * (-len(value) % 4))
+
+
+class Pbkdf2Hasher:
+    scheme = 'pbkdf2-sha256'
+    min_cost = 100_000
+    probe_cost = 20_000
+
+    def derive(self, password, salt, cost):
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, cost)
+
+    def cost_for(self, probe_ms, target_ms):
+        return max(self.min_cost, int(self.probe_cost * target_ms / max(probe_ms, 0.001)))
+
+    def too_cheap(self, cost, target_cost):
+        '''Число итераций линейно по времени: вдвое меньше цели — пора пересохранить.'''
+        return cost < self.min_cost or cost < target_cost // 2
+
+
+class ScryptHasher:
+    '''Стоимость — log2(N) при r=8, p=1; каждая единица удваивает время и память.'''
+    scheme = 'scrypt'
+    min_cost = 14
+    probe_cost = 12
+
+    def derive(self, password, salt, cost):
+        n = 2 ** cost
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=8, p=1, maxmem=256 * n * 8 + 1024 * 1024)
+
+    def cost_for(self, probe_ms, target_ms):
+        cost = self.probe_cost
+        while probe_ms * 2 ** (cost + 1 - self.probe_cost) <= target_ms:
+            cost += 1
+        return max(self.min_cost, cost)
+
+    def too_cheap(self, cost, target_cost):
+        '''Стоимость логарифмическая: на две единицы ниже цели — в четыре раза быстрее.'''
+        return cost < self.min_cost or cost < target_cost - 1
+
+
+HASHERS = {hasher.scheme: hasher for hasher in (Pbkdf2Hasher(), ScryptHasher())}
+
+_calibrated = {}
+_calibrate_lock = threading.Lock()
+_executor = None
+
+# Заглушка для выравнивания времени ответа, когда пользователь не найден
+_DUMMY_SALT = secrets.token_bytes(SALT_BYTES)
+
+
+def calibrate(scheme=HASH_SCHEME, target_ms=TARGET_MS):
+    '''
+    Подбирает стоимость так, чтобы один хэш занимал около target_ms на этой
+    машине. Выполняется один раз на контейнер при первом хэшировании.
+    '''
+    if scheme not in _calibrated:
+        with _calibrate_lock:
+            if scheme not in _calibrated:
+                hasher = HASHERS[scheme]
+                started = time.perf_counter()
+                hasher.derive('calibration', _DUMMY_SALT, hasher.probe_cost)
+                probe_ms = (time.perf_counter() - started) * 1000
+                _calibrated[scheme] = hasher.cost_for(probe_ms, target_ms)
+    return _calibrated[scheme]
+
+
+def _derive(scheme, password, salt, cost):
+    return HASHERS[scheme].derive(password, salt, cost)
+
+
+def _run(scheme, password, salt, cost):
+    '''При PASSWORD_HASH_PROCESSES > 0 вычисление уходит в пул процессов.'''
+    global _executor
+    with tracing.span('password-hash') as span:
+        span.set('password.scheme', scheme)
+        if HASH_PROCESSES <= 0:
+            return _derive(scheme, password, salt, cost)
+        if _executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _executor = ProcessPoolExecutor(max_workers=HASH_PROCESSES)
+        return _executor.submit(_derive, scheme, password, salt, cost).result()
+
+
+def hash_password(password, scheme=HASH_SCHEME):
+    cost = calibrate(scheme)
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = _run(scheme, password, salt, cost)
+    return f'${scheme}${cost}${_b64(salt)}${_b64(digest)}'
+
+
+def verify_password(password, stored):
+    '''
+    Возвращает (совпал ли пароль, нужно ли пересохранить хэш). Старые
+    несолёные sha256-хэши распознаются и всегда требуют пересохранения.
+    '''
+    if not stored:
+        _run(HASH_SCHEME, password, _DUMMY_SALT, calibrate())
+        return False, False
+
+    if not stored.startswith('$'):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+
+    try:
+        _, scheme, cost, salt, digest = stored.split('$')
+        cost = int(cost)
+        hasher = HASHERS[scheme]
+        salt, digest = _unb64(salt), _unb64(digest)
+    except (ValueError, KeyError, binascii.Error):
+        return False, False
+
+    actual = _run(scheme, password, salt, cost)
+    if not hmac.compare_digest(actual, digest):
+        return False, False
+
+    needs_rehash = scheme != HASH_SCHEME or hasher.too_cheap(cost, calibrate())
+    return True, needs_rehash
+
+
+if __name__ == '__main__':
+    # Бенчмарк: python passwords.py [секунд_на_схему]
+    import sys
+    from concurrent.futures import ProcessPoolExecutor
+
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    cores = os.cpu_count() or 1
+    for scheme in HASHERS:
+        cost = calibrate(scheme)
+        salt = secrets.token_bytes(SALT_BYTES)
+
+        done, started = 0, time.perf_counter()
+        while time.perf_counter() - started < duration:
+            _derive(scheme, 'benchmark-password', salt, cost)
+            done += 1
+        single = done / (time.perf_counter() - started)
+
+        with ProcessPoolExecutor(max_workers=cores) as pool:
+            batch = max(cores * 2, int(single * duration * cores))
+            started = time.perf_counter()
+            list(pool.map(_derive, [scheme] * batch, ['benchmark-password'] * batch, [salt] * batch, [cost] * batch))
+            parallel = batch / (time.perf_counter() - started)
+
+        print(f'{scheme}: cost={cost} single={single:.1f} h/s, '
+              f'{cores} cores={parallel:.1f} h/s, per core={parallel / cores:.1f} h/s')
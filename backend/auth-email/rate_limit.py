@@ -0,0 +1,149 @@
+'''
+Business: Ограничение частоты запросов (token bucket) по IP и email до проверки reCAPTCHA и обращений к БД
+Args: RATE_LIMIT_STORE (memory/postgres/off), RATE_LIMIT_*_BURST, RATE_LIMIT_*_PER_MINUTE из окружения
+Returns: None, если запрос пропущен, или (scope, retry_after) через check(); счётчики через stats()
+'''
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+import db
+
+STORE = os.environ.get('RATE_LIMIT_STORE', 'memory')
+MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+REPORT_SECONDS = float(os.environ.get('RATE_LIMIT_REPORT_SECONDS', '60'))
+
+# Область -> (ёмкость корзины, пополнение в минуту)
+LIMITS = {
+    'ip': (int(os.environ.get('RATE_LIMIT_IP_BURST', '20')),
+           float(os.environ.get('RATE_LIMIT_IP_PER_MINUTE', '30'))),
+    'email': (int(os.environ.get('RATE_LIMIT_EMAIL_BURST', '5')),
+              float(os.environ.get('RATE_LIMIT_EMAIL_PER_MINUTE', '3')))
+}
+
+
+class TokenBucketLimiter:
+    '''
+    Корзины в памяти контейнера. Число ключей ограничено MAX_KEYS: дольше
+    всех не использованные корзины вытесняются, а вытесненная корзина
+    при следующем запросе начинает полной — ошибка только в пользу клиента.
+    '''
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per_second):
+        '''Возвращает 0, если жетон выдан, иначе секунды до появления жетона.'''
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / per_second
+
+
+class PostgresLimiter:
+    '''
+    Общие корзины для нескольких экземпляров функции в UNLOGGED-таблице
+    rate_limit_buckets. Все ключи запроса проверяются одним атомарным upsert;
+    пополнение считается по времени сервера БД, а не контейнера.
+    '''
+
+    # Пополнение с момента прошлого запроса, но не выше ёмкости (EXCLUDED.tokens + 1)
+    REFILLED = """LEAST(EXCLUDED.tokens + 1, b.tokens + GREATEST(0, EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at)) * EXCLUDED.per_second)"""
+
+    def take_many(self, buckets):
+        rows = [(key, capacity - 1, per_second) for key, capacity, per_second in buckets]
+        values = ', '.join(['(%s, %s::float8, %s::float8)'] * len(rows))
+        with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO rate_limit_buckets AS b (key, tokens, per_second, allowed, updated_at)
+                SELECT key, tokens, per_second, TRUE, clock_timestamp()
+                FROM (VALUES {values}) AS v(key, tokens, per_second)
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = {self.REFILLED} - CASE WHEN {self.REFILLED} >= 1 THEN 1 ELSE 0 END,
+                    allowed = {self.REFILLED} >= 1,
+                    per_second = EXCLUDED.per_second,
+                    updated_at = clock_timestamp()
+                RETURNING key, allowed, tokens, per_second
+            """, [value for row in rows for value in row])
+            return {key: 0 if allowed else (1 - tokens) / per_second
+                    for key, allowed, tokens, per_second in cur.fetchall()}
+
+
+_memory = TokenBucketLimiter()
+_shared = PostgresLimiter() if STORE == 'postgres' else None
+_stats = {'allowed': 0, 'shed': {scope: 0 for scope in LIMITS}, 'store_errors': 0}
+_stats_lock = threading.Lock()
+# С нуля: всплеск сразу после холодного старта тоже попадает в лог
+_reported_at = 0.0
+
+
+def _record(scope):
+    global _reported_at
+    with _stats_lock:
+        if scope is None:
+            _stats['allowed'] += 1
+            return
+        _stats['shed'][scope] += 1
+        if time.monotonic() - _reported_at < REPORT_SECONDS:
+            return
+        _reported_at = time.monotonic()
+        snapshot = dict(_stats, shed=dict(_stats['shed']))
+    # Не чаще раза в REPORT_SECONDS, и только когда что-то было отброшено
+    print(json.dumps({'rate_limit': snapshot}))
+
+
+def check(action, ip=None, email=None):
+    '''
+    Проверяет корзины ip и email для действия. Сначала локальные корзины —
+    всплеск отбрасывается без сети и БД; при RATE_LIMIT_STORE=postgres
+    прошедшие запросы дополнительно сверяются с общими корзинами.
+    '''
+    if STORE == 'off':
+        return None
+
+    buckets = []
+    for scope, value in (('ip', ip), ('email', email.strip().lower() if isinstance(email, str) and email else None)):
+        if value:
+            capacity, per_minute = LIMITS[scope]
+            buckets.append((scope, f'{action}:{scope}:{value}', capacity, per_minute / 60))
+
+    for scope, key, capacity, per_second in buckets:
+        retry_after = _memory.take(key, capacity, per_second)
+        if retry_after:
+            _record(scope)
+            return scope, math.ceil(retry_after)
+
+    if _shared and buckets:
+        try:
+            waits = _shared.take_many([(key, capacity, per_second) for _, key, capacity, per_second in buckets])
+        except (psycopg2.Error, db.PoolTimeout):
+            # Общее хранилище недоступно — остаются локальные корзины
+            with _stats_lock:
+                _stats['store_errors'] += 1
+            waits = {}
+        for scope, key, _, _ in buckets:
+            if waits.get(key):
+                _record(scope)
+                return scope, math.ceil(waits[key])
+
+    _record(None)
+    return None
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats, shed=dict(_stats['shed']))
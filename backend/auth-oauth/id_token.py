@@ -0,0 +1,148 @@
+'''
+Business: Локальная проверка OpenID id_token (RS256) по закэшированному JWKS провайдера
+Args: id_token из ответа token-эндпоинта, конфиг провайдера с jwks_url и issuers, client_id
+Returns: Проверенные claims (sub, email, name, ...) или исключение InvalidToken; prefetch() обновляет JWKS заранее
+'''
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import threading
+import time
+
+import http_client
+
+JWKS_DEFAULT_TTL = float(os.environ.get('JWKS_DEFAULT_TTL', '3600'))
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', '60'))
+CLOCK_SKEW_SECONDS = 60
+
+# DigestInfo для SHA-256 из RFC 8017, используется в EMSA-PKCS1-v1_5
+SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def _b64int(value):
+    return int.from_bytes(_b64decode(value), 'big')
+
+
+class JwksCache:
+    '''
+    Держит ключи провайдера в памяти до истечения max-age из Cache-Control.
+    Неизвестный kid означает ротацию ключей: JWKS перечитывается, но не чаще
+    раза в JWKS_MIN_REFRESH_INTERVAL секунд, чтобы мусорные токены не
+    превращались в поток запросов к провайдеру.
+    '''
+
+    def __init__(self, url, upstream):
+        self.url = url
+        self.upstream = upstream
+        self.keys = {}
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        response = http_client.get(self.url, self.upstream)
+        if response.status_code != 200:
+            raise InvalidToken('JWKS недоступен')
+        keys = {}
+        for jwk in response.json().get('keys', []):
+            if jwk.get('kty') == 'RSA' and jwk.get('kid'):
+                keys[jwk['kid']] = (_b64int(jwk['n']), _b64int(jwk['e']))
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        ttl = float(match.group(1)) if match else JWKS_DEFAULT_TTL
+        now = time.monotonic()
+        self.keys = keys
+        self.fetched_at = now
+        self.expires_at = now + ttl
+
+    def get_key(self, kid):
+        with self._lock:
+            now = time.monotonic()
+            if now >= self.expires_at:
+                self._refresh()
+            elif kid not in self.keys and now - self.fetched_at >= JWKS_MIN_REFRESH_INTERVAL:
+                self._refresh()
+            key = self.keys.get(kid)
+        if key is None:
+            raise InvalidToken('Неизвестный kid')
+        return key
+
+    def refresh_if_expired(self):
+        with self._lock:
+            if time.monotonic() >= self.expires_at:
+                self._refresh()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _jwks_for(config, upstream):
+    url = config['jwks_url']
+    if url not in _caches:
+        with _caches_lock:
+            if url not in _caches:
+                _caches[url] = JwksCache(url, upstream)
+    return _caches[url]
+
+
+def prefetch(config, upstream):
+    '''
+    Перечитывает истёкший JWKS заранее, параллельно с обменом кода на токен.
+    verify() в это время ждёт на блокировке кэша, а не запрашивает JWKS второй раз.
+    '''
+    _jwks_for(config, upstream).refresh_if_expired()
+
+
+def _verify_rs256(signing_input, signature, key):
+    n, e = key
+    size = (n.bit_length() + 7) // 8
+    if len(signature) != size:
+        raise InvalidToken('Неверная длина подписи')
+    digest_info = SHA256_DIGEST_INFO + hashlib.sha256(signing_input).digest()
+    padding = b'\xff' * (size - len(digest_info) - 3)
+    expected = b'\x00\x01' + padding + b'\x00' + digest_info
+    actual = pow(int.from_bytes(signature, 'big'), e, n).to_bytes(size, 'big')
+    if not hmac.compare_digest(actual, expected):
+        raise InvalidToken('Неверная подпись')
+
+
+def verify(token, config, client_id, upstream):
+    try:
+        header_b64, payload_b64, signature_b64 = token.split('.')
+        header = json.loads(_b64decode(header_b64))
+        claims = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except (ValueError, AttributeError):
+        raise InvalidToken('Некорректный формат токена')
+    if not isinstance(header, dict) or not isinstance(claims, dict) or not isinstance(header.get('kid', ''), str):
+        raise InvalidToken('Некорректный формат токена')
+
+    if header.get('alg') != 'RS256':
+        raise InvalidToken('Неподдерживаемый алгоритм')
+
+    key = _jwks_for(config, upstream).get_key(header.get('kid'))
+    _verify_rs256(f'{header_b64}.{payload_b64}'.encode(), signature, key)
+
+    now = time.time()
+    if claims.get('iss') not in config['issuers']:
+        raise InvalidToken('Неверный издатель')
+    audience = claims.get('aud')
+    if audience != client_id and not (isinstance(audience, list) and client_id in audience):
+        raise InvalidToken('Неверный получатель')
+    if claims.get('exp', 0) + CLOCK_SKEW_SECONDS < now:
+        raise InvalidToken('Токен истёк')
+    if claims.get('iat', 0) - CLOCK_SKEW_SECONDS > now:
+        raise InvalidToken('Токен выпущен в будущем')
+
+    return claims
@@ -5,11 +5,19 @@ Returns: Редирект на OAuth провайдера или JWT токен
 '''
 import json
 import os
-import psycopg2
+import threading
 from urllib.parse import urlencode
-import requests
 from datetime import datetime, timedelta
-import secrets
+
+import db
+import http_client
+import signed_tokens
+import id_token
+import last_login
+import tracing
+
+PREFETCH_WORKERS = int(os.environ.get('OAUTH_PREFETCH_WORKERS', '4'))
+PREFETCH_WAIT = float(os.environ.get('OAUTH_PREFETCH_WAIT', '5'))
 
 PROVIDERS_CONFIG = {
     'google': {
@@ -18,7 +26,10 @@ PROVIDERS_CONFIG = {
         'user_info_url': 'https://www.googleapis.com/oauth2/v2/userinfo',
         'client_id_env': 'GOOGLE_CLIENT_ID',
         'client_secret_env': 'GOOGLE_CLIENT_SECRET',
-        'scope': 'openid email profile'
+        'scope': 'openid email profile',
+        'jwks_url': 'https://www.googleapis.com/oauth2/v3/certs',
+        'issuers': ('accounts.google.com', 'https://accounts.google.com'),
+        'id_token_fields': ('sub', 'email', 'name')
     },
     'yandex': {
         'auth_url': 'https://oauth.yandex.ru/authorize',
@@ -38,9 +49,64 @@ PROVIDERS_CONFIG = {
     }
 }
 
+# Вход через провайдера: поиск пользователя, создание при первом входе и сессия.
+# Запросы готовятся на соединении один раз (PREPARE) и дальше только выполняются.
+# Повторный вход в отложенном режиме не пишет в users: время входа уходит в
+# отложенную запись; заблокированному пользователю сессия не создаётся.
+CALLBACK_DEFERRED_SQL = db.Statement('oauth_login_deferred', f"""
+    WITH existing AS (
+        SELECT id, role, status FROM users
+        WHERE provider = %(provider)s AND provider_id = %(provider_id)s
+    ), inserted AS (
+        INSERT INTO users (email, name, provider, provider_id, email_verified, role, last_login)
+        SELECT %(email)s, %(name)s, %(provider)s, %(provider_id)s, TRUE, 'user', %(now)s
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        ON CONFLICT (provider, provider_id) DO NOTHING
+        RETURNING id, role, status
+    ), account AS (
+        SELECT id, role, status FROM existing
+        UNION ALL
+        SELECT id, role, status FROM inserted
+    ), session AS (
+        INSERT INTO sessions (user_id, token_hash, expires_at)
+        SELECT id, md5(%(token)s)::uuid, %(expires_at)s FROM account WHERE status <> 'blocked'
+    ){last_login.event_cte('existing')}
+    SELECT id, role, status FROM account
+""")
+
+# Вход или регистрация и создание сессии — один запрос. ON CONFLICT снимает гонку
+# одновременных первых входов; заблокированный пользователь не обновляется и не
+# возвращается, и сессия для него не создаётся
+CALLBACK_SYNC_SQL = db.Statement('oauth_login', """
+    WITH upsert AS (
+        INSERT INTO users (email, name, provider, provider_id, email_verified, role, last_login)
+        VALUES (%(email)s, %(name)s, %(provider)s, %(provider_id)s, TRUE, 'user', %(now)s)
+        ON CONFLICT (provider, provider_id) DO UPDATE SET last_login = EXCLUDED.last_login
+        WHERE users.status <> 'blocked'
+        RETURNING id, role
+    ), session AS (
+        INSERT INTO sessions (user_id, token_hash, expires_at)
+        SELECT id, md5(%(token)s)::uuid, %(expires_at)s FROM upsert
+    )
+    SELECT id, role FROM upsert
+""")
+
+_prefetch_pool = None
+_prefetch_lock = threading.Lock()
+
+# Прогрев при холодном старте, если платформа даёт время на инициализацию до первого запроса
+if os.environ.get('WARMUP_ON_START') == 'true':
+    db.warm_up()
+    http_client.warm_up()
+
+@tracing.trace_handler
+@db.count_round_trips
 def handler(event, context):
     method = event.get('httpMethod', 'GET')
     
+    # Отложенные last_login сбрасываются на любом вызове, а не только на следующем входе
+    last_login.flush_if_due()
+    
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
@@ -66,7 +132,14 @@ def handler(event, context):
         }
     
     if query_params.get('code'):
-        return handle_callback(provider, query_params, context)
+        try:
+            return handle_callback(provider, query_params, context)
+        except http_client.UpstreamUnavailable:
+            return {
+                'statusCode': 503,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Провайдер временно недоступен'})
+            }
     else:
         return initiate_oauth(provider, context)
 
@@ -109,6 +182,104 @@ def handle_callback(provider, query_params, context):
         }
     
     config = PROVIDERS_CONFIG[provider]
+    
+    # Подключение к БД, подготовка запроса входа и JWKS не зависят от ответов
+    # провайдера и идут в фоне, пока запрос ждёт обмена кода и профиля
+    pending = [prefetch(prepare_login)]
+    if config.get('jwks_url'):
+        pending.append(prefetch(id_token.prefetch, config, f'{provider}-jwks'))
+    try:
+        user_info, error = fetch_profile(provider, config, code)
+    finally:
+        # Ещё не начатые задачи не нужны: при ошибке до БД дело не дойдёт,
+        # а при успехе основной путь сделает их сам
+        for future in pending:
+            future.cancel()
+    
+    if error:
+        return error
+    
+    provider_id = str(user_info.get('id', user_info.get('sub', '')))
+    email = user_info.get('email', user_info.get('default_email', f'{provider_id}@{provider}.user'))
+    name = user_info.get('name', user_info.get('display_name', user_info.get('username', 'Пользователь')))
+    
+    session_token = signed_tokens.new_session_token()
+    expires_at = datetime.now() + timedelta(days=30)
+    
+    logged_in_at = datetime.now()
+    params = {'email': email, 'name': name, 'provider': provider, 'provider_id': provider_id,
+              'now': logged_in_at, 'token': session_token, 'expires_at': expires_at}
+    
+    # Дожидаемся соединения из фона, чтобы не открывать второе
+    wait_quietly(pending[0])
+    
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        if last_login.deferred():
+            # Пустой результат значит, что параллельный первый вход успел вставить
+            # пользователя между SELECT и INSERT, — тогда повтор находит его в existing
+            for _ in range(2):
+                cur.execute(CALLBACK_DEFERRED_SQL, params)
+                account = cur.fetchone()
+                if account:
+                    break
+            user = account[:2] if account and account[2] != 'blocked' else None
+        else:
+            cur.execute(CALLBACK_SYNC_SQL, params)
+            user = cur.fetchone()
+    
+    if not user:
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Аккаунт заблокирован'})
+        }
+    
+    user_id, role = user
+    last_login.touch(user_id, logged_in_at)
+    token = signed_tokens.issue(session_token, user_id, role, expires_at)
+    
+    return {
+        'statusCode': 302,
+        'headers': {
+            'Location': f"https://your-domain.com/?token={token}",
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': ''
+    }
+
+def prefetch(task, *args):
+    '''
+    Запускает подготовку, не зависящую от провайдера, в фоновом потоке. Ошибка
+    задачи только пишется в лог: основной путь при необходимости повторит её сам.
+    '''
+    global _prefetch_pool
+    if _prefetch_pool is None:
+        with _prefetch_lock:
+            if _prefetch_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='oauth-prefetch')
+    trace = tracing.current()
+    
+    def run():
+        with tracing.attach(trace):
+            try:
+                task(*args)
+            except Exception as e:
+                print(json.dumps({'oauth_prefetch': {'task': task.__name__, 'error': str(e)}}))
+    
+    return _prefetch_pool.submit(run)
+
+def wait_quietly(future, timeout=PREFETCH_WAIT):
+    from concurrent.futures import wait
+    wait([future], timeout=timeout)
+
+def prepare_login():
+    '''Берёт соединение из пула (на холодном старте — подключается) и готовит на нём запрос входа.'''
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        cur.prepare(CALLBACK_DEFERRED_SQL if last_login.deferred() else CALLBACK_SYNC_SQL)
+
+def fetch_profile(provider, config, code):
+    '''Обмен кода на токен и данные пользователя: (user_info, None) или (None, ответ с ошибкой).'''
     client_id = os.environ.get(config['client_id_env'])
     client_secret = os.environ.get(config['client_secret_env'])
     redirect_uri = f"https://your-domain.com/api/auth/oauth?provider={provider}"
@@ -121,93 +292,69 @@ def handle_callback(provider, query_params, context):
         'grant_type': 'authorization_code'
     }
     
-    token_response = requests.post(config['token_url'], data=token_data)
+    token_response = http_client.post(config['token_url'], provider, data=token_data)
     
     if token_response.status_code != 200:
-        return {
+        return None, {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Ошибка получения токена', 'details': token_response.text})
         }
     
-    access_token = token_response.json().get('access_token')
+    token_payload = token_response.json()
+    access_token = token_payload.get('access_token')
     
-    auth_header = 'Bearer ' + access_token
-    if provider == 'yandex':
-        auth_header = 'OAuth ' + access_token
+    user_info = claims_from_id_token(provider, config, client_id, token_payload.get('id_token'))
     
-    user_info_response = requests.get(
-        config['user_info_url'],
-        headers={'Authorization': auth_header}
-    )
+    if user_info is None:
+        user_info = fetch_user_info(provider, config, access_token)
     
-    if user_info_response.status_code != 200:
-        return {
+    if user_info is None:
+        return None, {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({'error': 'Ошибка получения данных пользователя'})
         }
     
-    user_info = user_info_response.json()
-    
-    if provider == 'twitter':
-        user_info = user_info.get('data', {})
+    return user_info, None
+
+def claims_from_id_token(provider, config, client_id, token):
+    '''
+    Для OpenID-провайдеров данные пользователя берутся прямо из подписанного
+    id_token, проверенного по закэшированному JWKS. None означает, что нужен
+    запрос к user_info_url: провайдер без JWKS, нет нужных полей или токен
+    не прошёл проверку.
+    '''
+    if not token or not config.get('jwks_url'):
+        return None
     
-    provider_id = str(user_info.get('id', user_info.get('sub', '')))
-    email = user_info.get('email', user_info.get('default_email', f'{provider_id}@{provider}.user'))
-    name = user_info.get('name', user_info.get('display_name', user_info.get('username', 'Пользователь')))
+    try:
+        claims = id_token.verify(token, config, client_id, f'{provider}-jwks')
+    except (id_token.InvalidToken, http_client.UpstreamUnavailable):
+        return None
     
-    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-    cur = conn.cursor()
+    if not all(claims.get(field) for field in config['id_token_fields']):
+        return None
     
-    cur.execute("""
-        SELECT id, role, status FROM users 
-        WHERE provider = %s AND provider_id = %s
-    """, (provider, provider_id))
+    return claims
+
+def fetch_user_info(provider, config, access_token):
+    auth_header = 'Bearer ' + access_token
+    if provider == 'yandex':
+        auth_header = 'OAuth ' + access_token
     
-    user = cur.fetchone()
+    user_info_response = http_client.get(
+        config['user_info_url'],
+        provider,
+        headers={'Authorization': auth_header}
+    )
     
-    if user:
-        user_id, role, status = user
-        
-        if status == 'blocked':
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Аккаунт заблокирован'})
-            }
-        
-        cur.execute("""
-            UPDATE users SET last_login = %s WHERE id = %s
-        """, (datetime.now(), user_id))
-    else:
-        cur.execute("""
-            INSERT INTO users (email, name, provider, provider_id, email_verified, role)
-            VALUES (%s, %s, %s, %s, TRUE, 'user')
-            RETURNING id, role
-        """, (email, name, provider, provider_id))
-        
-        user_id, role = cur.fetchone()
-    
-    token = secrets.token_urlsafe(32)
-    expires_at = datetime.now() + timedelta(days=30)
+    if user_info_response.status_code != 200:
+        return None
     
-    cur.execute("""
-        INSERT INTO sessions (user_id, token, expires_at)
-        VALUES (%s, %s, %s)
-    """, (user_id, token, expires_at))
+    user_info = user_info_response.json()
     
-    conn.commit()
-    cur.close()
-    conn.close()
+    if provider == 'twitter':
+        user_info = user_info.get('data', {})
     
-    return {
-        'statusCode': 302,
-        'headers': {
-            'Location': f"https://your-domain.com/?token={token}",
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': ''
-    }
+    return user_info
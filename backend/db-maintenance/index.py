@@ -0,0 +1,154 @@
+'''
+Business: Плановое обслуживание БД: перенос отложенных last_login, подсчёт входов по дням, пакетная очистка истёкших сессий, отзывов, кодов подтверждения, отправленных писем и старых корзин лимитов, пересчёт сводки user_stats
+Args: event - срабатывание таймера или HTTP POST с заголовком X-Maintenance-Secret
+Returns: Количество перенесённых входов, пересчитанных дней и удалённых строк по каждой таблице и время пересчёта сводки
+'''
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import db
+import tracing
+
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', '1000'))
+LAST_LOGIN_BATCH_SIZE = int(os.environ.get('LAST_LOGIN_BATCH_SIZE', '5000'))
+TIME_BUDGET_SECONDS = float(os.environ.get('MAINTENANCE_TIME_BUDGET', '20'))
+# Сессия живёт 30 дней, поэтому за последние 30 дней все сессии ещё не удалены и дни считаются заново
+LOGIN_DAYS_RECOUNT = 29
+
+# Таблица, колонка срока, доп. условие, дней хранения после истечения
+SWEEP_TASKS = [
+    ('sessions', 'expires_at', '', int(os.environ.get('SESSION_RETENTION_DAYS', '7'))),
+    ('email_verifications', 'expires_at', '', int(os.environ.get('VERIFICATION_RETENTION_DAYS', '1'))),
+    ('email_outbox', 'sent_at', "AND status = 'sent'", int(os.environ.get('OUTBOX_RETENTION_DAYS', '7'))),
+    ('session_revocations', 'expires_at', '', 0),
+    ('rate_limit_buckets', 'updated_at', '', int(os.environ.get('RATE_LIMIT_RETENTION_DAYS', '1')))
+]
+
+@tracing.trace_handler
+def handler(event, context):
+    method = event.get('httpMethod')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Maintenance-Secret',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+
+    if method:
+        headers = event.get('headers', {})
+        secret = headers.get('X-Maintenance-Secret') or headers.get('x-maintenance-secret')
+        if not secret or secret != os.environ.get('MAINTENANCE_SECRET'):
+            return {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Доступ запрещён'})
+            }
+
+    deadline = time.monotonic() + TIME_BUDGET_SECONDS
+    result = {
+        'last_login': flush_login_events(deadline),
+        # До очистки: дни, чьи сессии она удалит, должны быть уже посчитаны
+        'login_days': count_login_days(),
+        'removed': sweep_expired(deadline),
+        'user_stats_ms': refresh_user_stats()
+    }
+    print(json.dumps({'maintenance': result}))
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(result)
+    }
+
+def flush_login_events(deadline, batch_size=LAST_LOGIN_BATCH_SIZE):
+    '''
+    Переносит журнал входов в users.last_login: пачка событий удаляется из
+    login_events и схлопывается до последнего входа на пользователя, так что
+    на каждого пользователя приходится одно обновление за пачку, а не за вход.
+    Задержка last_login ограничена периодом таймера этой функции.
+    '''
+    result = {'events': 0, 'users': 0}
+    with db.connection() as conn, conn.cursor() as cur:
+        while time.monotonic() < deadline:
+            cur.execute("""
+                WITH drained AS (
+                    DELETE FROM login_events
+                    WHERE ctid = ANY(ARRAY(SELECT ctid FROM login_events LIMIT %s))
+                    RETURNING user_id, logged_in_at
+                ), latest AS (
+                    SELECT user_id, max(logged_in_at) AS logged_in_at FROM drained GROUP BY user_id
+                ), updated AS (
+                    UPDATE users u SET last_login = latest.logged_in_at
+                    FROM latest
+                    WHERE u.id = latest.user_id
+                      AND (u.last_login IS NULL OR u.last_login < latest.logged_in_at)
+                    RETURNING u.id
+                )
+                SELECT (SELECT count(*) FROM drained), (SELECT count(*) FROM updated)
+            """, (batch_size,))
+            events, users = cur.fetchone()
+            conn.commit()
+            result['events'] += events
+            result['users'] += users
+            if events < batch_size:
+                break
+    return result
+
+def count_login_days():
+    '''
+    Переносит число входов по дням из sessions в login_days, откуда их
+    берёт user_stats. Более старые дни в login_days остаются как были.
+    '''
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO login_days (day, logins)
+            SELECT created_at::date, count(*) FROM sessions
+            WHERE created_at >= current_date - %s
+            GROUP BY created_at::date
+            ON CONFLICT (day) DO UPDATE SET logins = EXCLUDED.logins
+        """, (LOGIN_DAYS_RECOUNT,))
+        return cur.rowcount
+
+def refresh_user_stats():
+    '''
+    Пересчитывает сводку для дашборда админки. CONCURRENTLY не блокирует
+    чтение user_stats на время пересчёта; свежесть сводки — период таймера.
+    '''
+    started = time.monotonic()
+    with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY user_stats")
+    return round((time.monotonic() - started) * 1000, 1)
+
+def sweep_expired(deadline, batch_size=SWEEP_BATCH_SIZE):
+    '''
+    Удаляет устаревшие строки пачками по batch_size, каждая пачка в своей
+    короткой транзакции: блокировки держатся недолго, WAL пишется ровно,
+    а при исчерпании бюджета времени остаток дочистит следующий запуск.
+    '''
+    removed = {}
+    with db.connection() as conn, conn.cursor() as cur:
+        for table, column, extra_condition, retention_days in SWEEP_TASKS:
+            cutoff = datetime.now() - timedelta(days=retention_days)
+            removed[table] = 0
+            while time.monotonic() < deadline:
+                cur.execute(f"""
+                    DELETE FROM {table}
+                    WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM {table}
+                        WHERE {column} < %s {extra_condition}
+                        LIMIT %s
+                    ))
+                """, (cutoff, batch_size))
+                conn.commit()
+                removed[table] += cur.rowcount
+                if cur.rowcount < batch_size:
+                    break
+    return removed
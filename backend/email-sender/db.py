@@ -0,0 +1,503 @@
+'''
+Business: Общий пул соединений PostgreSQL, переживающий тёплые вызовы функции
+Args: DATABASE_URL, DATABASE_REPLICA_URL и настройки DB_POOL_*, DB_REPLICA_* из окружения
+Returns: Соединение из пула через connection(), для чтения — через read_connection(), подготовленные запросы через Statement, счётчики через pool_stats(), prepared_stats(), replica_stats() и round_trips()
+'''
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+import tracing
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', '300'))
+POOL_CHECK_INTERVAL = float(os.environ.get('DB_POOL_CHECK_INTERVAL', '30'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '10'))
+# false — для PgBouncer в режиме транзакций, где PREPARE не переживает транзакцию
+PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', 'true') == 'true'
+
+# Необязательная реплика для запросов только на чтение; без неё всё идёт в DATABASE_URL
+REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+# Отставание реплики в секундах, после которого чтение на REPLICA_PIN_SECONDS уходит в основную БД
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', '5'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_LAG_CHECK_INTERVAL', '5'))
+REPLICA_PIN_SECONDS = float(os.environ.get('DB_REPLICA_PIN_SECONDS', '30'))
+# Записанное моложе этого читается из основной БД; должно быть не меньше DB_REPLICA_MAX_LAG
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('DB_READ_YOUR_WRITES_SECONDS', '10'))
+
+# SQLSTATE: EXECUTE неизвестного серверу оператора и повторный PREPARE того же имени
+INVALID_STATEMENT_NAME = '26000'
+DUPLICATE_PREPARED_STATEMENT = '42P05'
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+_local = threading.local()
+
+
+def _count_round_trips(n=1):
+    _local.round_trips = getattr(_local, 'round_trips', 0) + n
+
+
+class Statement:
+    '''
+    Частый запрос, который на каждом соединении разбирается и планируется
+    один раз. Первый execute на соединении отправляет PREPARE и EXECUTE одним
+    обращением, следующие — только EXECUTE. Имя содержит хэш текста, поэтому
+    одно имя на любом соединении означает один и тот же запрос.
+    '''
+
+    def __init__(self, name, sql):
+        self.sql = sql
+        self.name = f'{name}_{hashlib.md5(sql.encode()).hexdigest()[:8]}'
+        self.param_names = []
+        positions = {}
+
+        def number(match):
+            key = match.group(1)
+            if match.group(0) == '%%':
+                return '%%'
+            if key is None or key not in positions:
+                self.param_names.append(key)
+                positions.setdefault(key, len(self.param_names))
+                return f'${len(self.param_names)}'
+            return f'${positions[key]}'
+
+        self.prepare_sql = f'PREPARE {self.name} AS {_PLACEHOLDER.sub(number, sql)}'
+        self.execute_sql = f'EXECUTE {self.name}'
+        if self.param_names:
+            self.execute_sql += f" ({', '.join(['%s'] * len(self.param_names))})"
+
+    def arguments(self, vars):
+        if isinstance(vars, dict):
+            return tuple(vars[name] for name in self.param_names)
+        return tuple(vars or ())
+
+
+_prepared = {'enabled': PREPARED_STATEMENTS, 'prepares': 0, 'executes': 0}
+
+
+def _disable_prepared(reason):
+    if _prepared['enabled']:
+        _prepared['enabled'] = False
+        print(json.dumps({'db': {'prepared_statements': 'disabled', 'reason': reason}}))
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        _count_round_trips()
+        with tracing.span('db-query', tracing.KIND_CLIENT) as span:
+            if isinstance(query, Statement):
+                span.set('db.statement', query.sql)
+                if _prepared['enabled']:
+                    span.set('db.prepared', query.name)
+                    return self._execute_prepared(query, vars)
+                return super().execute(query.sql, vars)
+            span.set('db.statement', query)
+            return super().execute(query, vars)
+
+    def prepare(self, statement):
+        '''
+        Готовит запрос на соединении заранее, не выполняя его, — пока запрос
+        ждёт чего-то другого. Если запрос уже готов, обращения к серверу нет.
+        '''
+        conn = self.connection
+        if not _prepared['enabled'] or statement.name in conn.prepared:
+            return
+        _count_round_trips()
+        with tracing.span('db-prepare', tracing.KIND_CLIENT) as span:
+            span.set('db.statement', statement.sql)
+            try:
+                _prepared['prepares'] += 1
+                # Пустые параметры, чтобы %% в тексте стало %, как при выполнении
+                super().execute(statement.prepare_sql, ())
+            except psycopg2.Error as e:
+                if e.pgcode != DUPLICATE_PREPARED_STATEMENT:
+                    raise
+            conn.prepared.add(statement.name)
+
+    def _execute_prepared(self, statement, vars):
+        conn = self.connection
+        # Повторить можно, только если ошибка не оборвала уже начатую транзакцию
+        retryable = conn.autocommit or conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        args = statement.arguments(vars)
+        try:
+            if statement.name in conn.prepared:
+                _prepared['executes'] += 1
+                return super().execute(statement.execute_sql, args)
+            _prepared['prepares'] += 1
+            super().execute(f'{statement.prepare_sql}; {statement.execute_sql}', args)
+            conn.prepared.add(statement.name)
+            return
+        except psycopg2.Error as e:
+            if e.pgcode == DUPLICATE_PREPARED_STATEMENT:
+                # PREPARE прошёл раньше, а упал EXECUTE того же обращения
+                conn.prepared.add(statement.name)
+            elif e.pgcode == INVALID_STATEMENT_NAME:
+                # Подготовленный на этом соединении оператор пропал — запросы
+                # попадают на разные серверные сессии (PgBouncer в режиме транзакций)
+                _disable_prepared(str(e).strip())
+            else:
+                # Ошибки разбора (класс 42) — от PREPARE, остальные — уже от EXECUTE
+                if not (e.pgcode or '').startswith('42'):
+                    conn.prepared.add(statement.name)
+                raise
+            if not retryable:
+                raise
+        if not conn.autocommit:
+            conn.rollback()
+        return self.execute(statement, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        _count_round_trips(len(vars_list))
+        with tracing.span('db-query', tracing.KIND_CLIENT) as span:
+            span.set('db.statement', query)
+            span.set('db.batch_size', len(vars_list))
+            return super().executemany(query, vars_list)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    '''Считает обращения к серверу: запросы, а также COMMIT/ROLLBACK открытой транзакции.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+        # Имена операторов, подготовленных на этой серверной сессии; после
+        # переподключения набор пуст и операторы готовятся заново
+        self.prepared = set()
+        # True у соединений пула реплики, которые выдаёт read_connection()
+        self.replica = False
+
+    def commit(self):
+        if self.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return super().commit()
+        _count_round_trips()
+        with tracing.span('db-commit', tracing.KIND_CLIENT):
+            super().commit()
+
+    def rollback(self):
+        if self.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return super().rollback()
+        _count_round_trips()
+        with tracing.span('db-rollback', tracing.KIND_CLIENT):
+            super().rollback()
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    '''
+    Пул живёт на уровне модуля, поэтому соединения переиспользуются между
+    вызовами в тёплом контейнере. Простаивающие дольше idle_timeout закрываются,
+    простаивающие дольше check_interval перед выдачей проверяются SELECT 1.
+    '''
+
+    def __init__(self, dsn, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 check_interval=POOL_CHECK_INTERVAL, acquire_timeout=POOL_ACQUIRE_TIMEOUT):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self.stats = {'hits': 0, 'misses': 0, 'reconnects': 0, 'discarded': 0}
+
+    def _connect(self):
+        with tracing.span('db-connect', tracing.KIND_CLIENT) as span:
+            span.set('server.address', _dsn_key(self.dsn))
+            return psycopg2.connect(self.dsn, connection_factory=CountingConnection)
+
+    def _is_alive(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    conn, released_at = self._idle.pop()
+                    if now - released_at > self.idle_timeout:
+                        self._close_quietly(conn)
+                        self._size -= 1
+                        self.stats['discarded'] += 1
+                        continue
+                    break
+                else:
+                    conn = None
+                if conn is not None:
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    released_at = None
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise PoolTimeout('Нет свободных соединений в пуле')
+                self._cond.wait(remaining)
+
+        try:
+            if conn is None:
+                self.stats['misses'] += 1
+                return self._connect()
+            if self._is_alive(conn, now - released_at):
+                self.stats['hits'] += 1
+                return conn
+            self._close_quietly(conn)
+            self.stats['reconnects'] += 1
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        with self._cond:
+            if discard or conn.closed:
+                self._close_quietly(conn)
+                self._size -= 1
+                self.stats['discarded'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._close_quietly(conn)
+                self._size -= 1
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dsn=None):
+    dsn = dsn or os.environ.get('DATABASE_URL')
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = ConnectionPool(dsn)
+                _pools[dsn] = pool
+    return pool
+
+
+@contextmanager
+def connection(dsn=None, autocommit=False):
+    '''
+    Выдаёт соединение из пула. При исключении транзакция откатывается,
+    а соединение, которое не удалось откатить или закрытое сервером,
+    выбрасывается из пула. autocommit=True подходит для потоков из одного
+    запроса: не нужны ни COMMIT, ни ROLLBACK при возврате в пул.
+    '''
+    pool = get_pool(dsn)
+    with _lease(pool, pool.acquire(), autocommit) as conn:
+        yield conn
+
+
+@contextmanager
+def _lease(pool, conn, autocommit):
+    discard = False
+    if autocommit:
+        conn.autocommit = True
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            discard = True
+        raise
+    finally:
+        if autocommit and not conn.closed:
+            try:
+                conn.autocommit = False
+            except psycopg2.Error:
+                discard = True
+        pool.release(conn, discard=discard)
+
+
+# На первичном сервере отставания нет; на реплике, которая проиграла весь
+# полученный WAL, тоже — даже если последняя транзакция была давно
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+_replica = {'pinned_until': 0.0, 'checked_at': 0.0, 'written_at': 0.0, 'lag': None,
+            'reads': 0, 'primary_reads': 0, 'pins': 0}
+_replica_lock = threading.Lock()
+
+
+def _pin_to_primary(reason):
+    now = time.monotonic()
+    with _replica_lock:
+        pinned = _replica['pinned_until'] > now
+        _replica['pinned_until'] = now + REPLICA_PIN_SECONDS
+        # Когда пауза кончится, реплика сначала снова проверяется
+        _replica['checked_at'] = 0.0
+        if not pinned:
+            _replica['pins'] += 1
+    if not pinned:
+        print(json.dumps({'db': {'replica': 'pinned', 'reason': reason, 'seconds': REPLICA_PIN_SECONDS}}))
+
+
+def _lag_check_due():
+    now = time.monotonic()
+    with _replica_lock:
+        if now - _replica['checked_at'] < REPLICA_LAG_CHECK_INTERVAL:
+            return False
+        _replica['checked_at'] = now
+        return True
+
+
+def _acquire_replica(written_at):
+    '''Соединение с репликой или None, если читать нужно из основной БД.'''
+    if not REPLICA_URL or _replica['pinned_until'] > time.monotonic():
+        return None
+    if time.time() - max(written_at or 0, _replica['written_at']) < READ_YOUR_WRITES_SECONDS:
+        return None
+
+    pool = get_pool(REPLICA_URL)
+    try:
+        conn = pool.acquire()
+    except (psycopg2.Error, PoolTimeout) as e:
+        _pin_to_primary(f'connect: {e}'.strip())
+        return None
+    conn.replica = True
+    if not _lag_check_due():
+        return conn
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute(REPLICA_LAG_SQL)
+            lag = float(cur.fetchone()[0])
+        conn.rollback()
+    except psycopg2.Error as e:
+        pool.release(conn, discard=True)
+        _pin_to_primary(f'lag check: {e}'.strip())
+        return None
+    _replica['lag'] = round(lag, 3)
+    if lag > REPLICA_MAX_LAG:
+        pool.release(conn)
+        _pin_to_primary(f'lag {lag:.1f}s > {REPLICA_MAX_LAG:g}s')
+        return None
+    return conn
+
+
+@contextmanager
+def read_connection(written_at=None, autocommit=True):
+    '''
+    Соединение для запросов только на чтение. Это реплика DATABASE_REPLICA_URL,
+    если она задана, проверка отставания её не отключила, а нужные данные
+    записаны (written_at, unix-время) раньше чем READ_YOUR_WRITES_SECONDS
+    назад. Иначе это основная БД. Откуда пришли строки, видно по conn.replica.
+    '''
+    conn = _acquire_replica(written_at)
+    if conn is None:
+        if REPLICA_URL:
+            _replica['primary_reads'] += 1
+        with connection(autocommit=autocommit) as conn:
+            yield conn
+        return
+
+    _replica['reads'] += 1
+    with _lease(get_pool(REPLICA_URL), conn, autocommit) as conn:
+        yield conn
+
+
+def note_write():
+    '''Запись в этом процессе: следующие READ_YOUR_WRITES_SECONDS read_connection() читает из основной БД.'''
+    _replica['written_at'] = time.time()
+
+
+def close_all():
+    '''Закрывает простаивающие соединения всех пулов — при остановке долгоживущего процесса.'''
+    for pool in list(_pools.values()):
+        pool.close_all()
+
+
+def warm_up(dsn=None):
+    '''Открывает соединение заранее, чтобы первый запрос не платил за подключение к БД.'''
+    try:
+        pool = get_pool(dsn)
+        pool.release(pool.acquire())
+    except (psycopg2.Error, PoolTimeout):
+        pass
+
+
+def round_trips():
+    return getattr(_local, 'round_trips', 0)
+
+
+def count_round_trips(handler):
+    '''Обнуляет счётчик обращений к БД на вызов и отдаёт его в заголовке X-DB-Round-Trips.'''
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        _local.round_trips = 0
+        response = handler(event, context)
+        if isinstance(response, dict):
+            response.setdefault('headers', {})['X-DB-Round-Trips'] = str(round_trips())
+        return response
+    return wrapper
+
+
+def prepared_stats():
+    return dict(_prepared)
+
+
+def replica_stats():
+    return {'configured': bool(REPLICA_URL), 'pinned': _replica['pinned_until'] > time.monotonic(),
+            'lag': _replica['lag'], 'reads': _replica['reads'], 'primary_reads': _replica['primary_reads'],
+            'pins': _replica['pins']}
+
+
+def pool_stats():
+    return {_dsn_key(dsn): dict(pool.stats, size=pool._size, idle=len(pool._idle))
+            for dsn, pool in _pools.items()}
+
+
+def _dsn_key(dsn):
+    return (dsn or '').rsplit('@', 1)[-1]
@@ -0,0 +1,210 @@
+'''
+Business: Отправка писем из очереди email_outbox пачками через одну SMTP-сессию
+Args: event - срабатывание таймера или HTTP POST с заголовком X-Sender-Secret
+Returns: Количество отправленных, отложенных и окончательно неотправленных писем
+'''
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from string import Template
+
+import db
+import tracing
+
+BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE', '50'))
+MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '5'))
+RETRY_BASE_SECONDS = int(os.environ.get('EMAIL_RETRY_BASE_SECONDS', '30'))
+
+# Шаблоны разбираются один раз при загрузке модуля, на письмо остаётся только подстановка
+TEMPLATES = {
+    'verification': (
+        'Код подтверждения PozLite Studio',
+        Template('''
+    <html>
+        <body>
+            <h2>Добро пожаловать в PozLite Studio!</h2>
+            <p>Ваш код подтверждения:</p>
+            <h1 style="color: #8B5CF6; font-size: 32px;">$code</h1>
+            <p>Код действителен 5 минут.</p>
+        </body>
+    </html>
+    ''')
+    )
+}
+
+@tracing.trace_handler
+def handler(event, context):
+    method = event.get('httpMethod')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Sender-Secret',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+
+    if method:
+        headers = event.get('headers', {})
+        secret = headers.get('X-Sender-Secret') or headers.get('x-sender-secret')
+        if not secret or secret != os.environ.get('EMAIL_SENDER_SECRET'):
+            return {
+                'statusCode': 403,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Доступ запрещён'})
+            }
+
+    result = drain_outbox()
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(result)
+    }
+
+def render(template, recipient, payload):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    
+    subject, body = TEMPLATES[template]
+    msg = MIMEMultipart()
+    msg['From'] = os.environ.get('SMTP_FROM') or os.environ.get('SMTP_USER')
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body.substitute(payload), 'html'))
+    return msg
+
+class SmtpSession:
+    '''
+    Одно SMTP-соединение на всю пачку: STARTTLS и логин выполняются один раз,
+    при обрыве соединение поднимается заново перед следующим письмом.
+    '''
+
+    def __init__(self):
+        self.host = os.environ.get('SMTP_HOST')
+        self.port = int(os.environ.get('SMTP_PORT', '587'))
+        self.user = os.environ.get('SMTP_USER')
+        self.password = os.environ.get('SMTP_PASSWORD')
+        self.starttls = os.environ.get('SMTP_STARTTLS', 'true') == 'true'
+        self.timeout = float(os.environ.get('SMTP_TIMEOUT', '10'))
+        self.server = None
+
+    def _open(self):
+        import smtplib
+        with tracing.span('smtp-connect', tracing.KIND_CLIENT) as span:
+            span.set('server.address', self.host)
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                server.starttls()
+            if self.password:
+                server.login(self.user, self.password)
+        self.server = server
+
+    def send(self, msg):
+        import smtplib
+        if self.server is None:
+            self._open()
+        with tracing.span('smtp-send', tracing.KIND_CLIENT):
+            try:
+                self.server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self.server = None
+                self._open()
+                self.server.send_message(msg)
+
+    def close(self):
+        import smtplib
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+def drain_outbox(batch_size=BATCH_SIZE):
+    '''
+    Забирает пачку готовых к отправке писем (FOR UPDATE SKIP LOCKED позволяет
+    запускать несколько отправителей параллельно) и отправляет их через одну
+    SMTP-сессию. Неудачные попытки откладываются с экспоненциальной задержкой,
+    после MAX_ATTEMPTS письмо помечается failed. Письмо с неизвестным шаблоном
+    или неполным payload помечается failed сразу и не мешает отправке остальных.
+    '''
+    sent, retried, failed = [], [], []
+    session = SmtpSession()
+
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT id, recipient, template, payload, attempts
+            FROM email_outbox
+            WHERE status = 'pending' AND next_attempt_at <= %s
+            ORDER BY next_attempt_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (datetime.now(), batch_size))
+
+        rows = cur.fetchall()
+        if not rows:
+            # Пустая очередь — частый случай для таймера: SMTP и email.mime не импортируются
+            return {'sent': 0, 'retried': 0, 'failed': 0}
+        
+        import smtplib
+        
+        error = None
+        try:
+            for outbox_id, recipient, template, payload, attempts in rows:
+                # Письмо, которое не собирается, не станет собираться при повторе: сразу failed
+                try:
+                    msg = render(template, recipient, payload)
+                except (KeyError, ValueError, TypeError) as e:
+                    failed.append((outbox_id, attempts + 1, 'render: %s' % e))
+                    continue
+                if error is None or session.server is not None:
+                    try:
+                        session.send(msg)
+                        sent.append(outbox_id)
+                        continue
+                    except (smtplib.SMTPException, OSError) as e:
+                        error = str(e)
+                # Если SMTP-сервер недоступен, остаток пачки откладывается без новых подключений
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    failed.append((outbox_id, attempts, error))
+                else:
+                    retry_at = datetime.now() + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+                    retried.append((outbox_id, attempts, error, retry_at))
+        finally:
+            session.close()
+
+        if sent:
+            cur.execute("""
+                UPDATE email_outbox SET status = 'sent', attempts = attempts + 1, sent_at = %s
+                WHERE id = ANY(%s)
+            """, (datetime.now(), sent))
+        for outbox_id, attempts, error, retry_at in retried:
+            cur.execute("""
+                UPDATE email_outbox SET attempts = %s, last_error = %s, next_attempt_at = %s
+                WHERE id = %s
+            """, (attempts, error, retry_at, outbox_id))
+        for outbox_id, attempts, error in failed:
+            cur.execute("""
+                UPDATE email_outbox SET status = 'failed', attempts = %s, last_error = %s
+                WHERE id = %s
+            """, (attempts, error, outbox_id))
+
+        conn.commit()
+
+    return {'sent': len(sent), 'retried': len(retried), 'failed': len(failed)}
+
+if __name__ == '__main__':
+    # Постоянный отправитель для self-hosted запуска: python index.py [интервал_сек]
+    interval = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    while True:
+        result = drain_outbox()
+        if not result['sent'] and not result['retried'] and not result['failed']:
+            time.sleep(interval)
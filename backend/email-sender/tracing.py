@@ -0,0 +1,259 @@
+'''
+Business: Трассировка вызова функции: спаны БД, HTTP и SMTP, JSON-строка в лог, заголовок Server-Timing и экспорт в OTLP/JSON
+Args: TRACING_ENABLED, TRACING_EXPORT_FILE, TRACING_SERVICE_NAME из окружения
+Returns: Контекст span(name) для замеров и декоратор trace_handler для handler
+'''
+import functools
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('TRACING_ENABLED') == 'true'
+# Файл в формате OTLP/JSON (по строке на вызов), его читает otlpjsonfile receiver коллектора OpenTelemetry
+EXPORT_FILE = os.environ.get('TRACING_EXPORT_FILE')
+SERVICE_NAME = (os.environ.get('TRACING_SERVICE_NAME')
+                or os.path.basename(os.path.dirname(os.path.abspath(__file__))))
+
+# SpanKind из OTLP
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+
+STATUS_ERROR = 2
+
+_local = threading.local()
+_export_lock = threading.Lock()
+# Функции, уже вызванные в этом процессе; в шлюзе их несколько на один модуль
+_warm = set()
+
+
+class _NoopSpan:
+    '''Возвращается, когда трассировка выключена или вызов не трассируется: ни времени, ни аллокаций.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Trace:
+    def __init__(self, traceparent=None):
+        parent = _parse_traceparent(traceparent)
+        self.trace_id, self.parent_id = parent or (os.urandom(16).hex(), None)
+        self.spans = []
+        self.root = None
+        # Длительности считаются по монотонным часам, стена нужна только для OTLP
+        self._wall_ns = time.time_ns()
+        self._perf_ns = time.perf_counter_ns()
+
+    def now_ns(self):
+        return self._wall_ns + time.perf_counter_ns() - self._perf_ns
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'kind', 'attributes', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, trace, name, kind=KIND_INTERNAL):
+        self.trace = trace
+        self.name = name
+        self.kind = kind
+        self.attributes = {}
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = None
+        self.start_ns = self.end_ns = 0
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        # Стек вложенности свой у каждого потока, спаны всех потоков — в одной трассе
+        stack = _local.stack
+        self.parent_id = stack[-1].span_id if stack else self.trace.parent_id
+        stack.append(self)
+        self.start_ns = self.trace.now_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = self.trace.now_ns()
+        _local.stack.pop()
+        if exc_type is not None:
+            self.error = f'{exc_type.__name__}: {exc}'
+        self.trace.spans.append(self)
+        return False
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1e6
+
+
+def _parse_traceparent(value):
+    # W3C traceparent: 00-<trace_id 32 hex>-<span_id 16 hex>-<flags>
+    parts = (value or '').split('-')
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None
+
+
+def span(name, kind=KIND_INTERNAL):
+    '''
+    Замер участка внутри текущего вызова. Вне trace_handler и при выключенной
+    трассировке возвращает общий пустой спан, поэтому оборачивать можно
+    даже самые частые операции вроде cursor.execute.
+    '''
+    if not ENABLED:
+        return _NOOP
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _NOOP
+    return Span(trace, name, kind)
+
+
+def current():
+    '''Текущая трасса потока — чтобы продолжить её в рабочем потоке через attach().'''
+    return getattr(_local, 'trace', None) if ENABLED else None
+
+
+class attach:
+    '''
+    Привязывает трассу к рабочему потоку на время блока: спаны потока пишутся
+    в неё же дочерними к корневому спану вызова.
+    '''
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = (getattr(_local, 'trace', None), getattr(_local, 'stack', None))
+        _local.trace = self.trace
+        _local.stack = [self.trace.root] if self.trace and self.trace.root else []
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.trace, _local.stack = self.previous
+        return False
+
+
+def trace_handler(handler):
+    '''
+    Корневой спан на вызов handler: одна JSON-строка в лог с длительностями
+    по видам спанов и признаком холодного старта, заголовок Server-Timing
+    в ответе и, при TRACING_EXPORT_FILE, запись трассы в OTLP/JSON.
+    '''
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not ENABLED:
+            return handler(event, context)
+
+        name = getattr(context, 'function_name', None) or SERVICE_NAME
+        cold = name not in _warm
+        _warm.add(name)
+        event = event or {}
+        headers = event.get('headers') or {}
+        trace = Trace(headers.get('traceparent') or headers.get('Traceparent'))
+        root = Span(trace, event.get('httpMethod') or 'timer', KIND_SERVER)
+        root.set('faas.coldstart', cold)
+        root.set('faas.name', name)
+        trace.root = root
+
+        response = None
+        _local.trace = trace
+        _local.stack = []
+        try:
+            with root:
+                response = handler(event, context)
+        finally:
+            _local.trace = None
+            if isinstance(response, dict):
+                root.set('http.status_code', response.get('statusCode'))
+                response_headers = response.setdefault('headers', {})
+                response_headers['Server-Timing'] = server_timing(trace, root)
+                response_headers['Timing-Allow-Origin'] = '*'
+            _report(trace, root, cold)
+        return response
+    return wrapper
+
+
+def summarize(trace):
+    '''Спаны, сгруппированные по имени: число и суммарная длительность в мс.'''
+    summary = {}
+    for item in trace.spans:
+        if item.kind == KIND_SERVER:
+            continue
+        entry = summary.setdefault(item.name, {'count': 0, 'ms': 0.0})
+        entry['count'] += 1
+        entry['ms'] += item.duration_ms
+    for entry in summary.values():
+        entry['ms'] = round(entry['ms'], 2)
+    return summary
+
+
+def server_timing(trace, root):
+    metrics = [f'{name};desc="x{entry["count"]}";dur={entry["ms"]}'
+               for name, entry in summarize(trace).items()]
+    metrics.append(f'total;dur={round(root.duration_ms, 2)}')
+    return ', '.join(metrics)
+
+
+def _report(trace, root, cold):
+    service = root.attributes.get('faas.name') or SERVICE_NAME
+    print(json.dumps({'trace': {
+        'function': service,
+        'trace_id': trace.trace_id,
+        'cold': cold,
+        'status': root.attributes.get('http.status_code'),
+        'error': root.error,
+        'duration_ms': round(root.duration_ms, 2),
+        'spans': summarize(trace)
+    }}, default=str))
+    if EXPORT_FILE:
+        export(trace, service)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        if isinstance(value, bytes):
+            value = value.decode(errors='replace')
+        typed = {'stringValue': ' '.join(str(value).split())}
+    return {'key': key, 'value': typed}
+
+
+def export(trace, service=SERVICE_NAME, path=None):
+    '''Дописывает трассу одной строкой ExportTraceServiceRequest в OTLP/JSON.'''
+    spans = []
+    for item in trace.spans:
+        otlp_span = {
+            'traceId': trace.trace_id,
+            'spanId': item.span_id,
+            'name': item.name,
+            'kind': item.kind,
+            'startTimeUnixNano': str(item.start_ns),
+            'endTimeUnixNano': str(item.end_ns),
+            'attributes': [_attribute(key, value) for key, value in item.attributes.items() if value is not None]
+        }
+        if item.parent_id:
+            otlp_span['parentSpanId'] = item.parent_id
+        if item.error:
+            otlp_span['status'] = {'code': STATUS_ERROR, 'message': item.error}
+        spans.append(otlp_span)
+
+    line = json.dumps({'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', service)]},
+        'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': spans}]
+    }]})
+    with _export_lock, open(path or EXPORT_FILE, 'a') as f:
+        f.write(line + '\n')
@@ -3,11 +3,22 @@ Business: Получение информации о текущем пользо
 Args: event - HTTP GET запрос с заголовком X-Auth-Token
 Returns: Данные пользователя (id, email, name, role, status)
 '''
+import hashlib
 import json
 import os
-import psycopg2
-from datetime import datetime
 
+import db
+import session_cache
+import tracing
+
+# Прогрев при холодном старте, если платформа даёт время на инициализацию до первого запроса
+if os.environ.get('WARMUP_ON_START') == 'true':
+    db.warm_up()
+    if db.REPLICA_URL:
+        db.warm_up(db.REPLICA_URL)
+
+@tracing.trace_handler
+@db.count_round_trips
 def handler(event, context):
     method = event.get('httpMethod', 'GET')
     
@@ -17,7 +28,7 @@ def handler(event, context):
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -33,20 +44,7 @@ def handler(event, context):
             'body': json.dumps({'error': 'Токен не предоставлен'})
         }
     
-    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT u.id, u.email, u.name, u.avatar_url, u.role, u.status, u.provider, u.created_at
-        FROM users u
-        INNER JOIN sessions s ON u.id = s.user_id
-        WHERE s.token = %s AND s.expires_at > %s
-    """, (token, datetime.now()))
-    
-    user = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    user = session_cache.get_user(token)
     
     if not user:
         return {
@@ -55,11 +53,23 @@ def handler(event, context):
             'body': json.dumps({'error': 'Недействительный или истёкший токен'})
         }
     
-    user_id, email, name, avatar_url, role, status, provider, created_at = user
+    user_id, email, name, avatar_url, role, status, provider, created_at, updated_at = user
+    etag = user_etag(user_id, updated_at)
+    response_headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'private, no-cache',
+        'ETag': etag
+    }
+    
+    # Данные не менялись — тело не собираем и не отправляем
+    if etag_matches(headers.get('If-None-Match') or headers.get('if-none-match'), etag):
+        return {'statusCode': 304, 'headers': response_headers, 'body': ''}
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'headers': response_headers,
         'body': json.dumps({
             'id': user_id,
             'email': email,
@@ -71,3 +81,13 @@ def handler(event, context):
             'createdAt': created_at.isoformat() if created_at else None
         })
     }
+
+def user_etag(user_id, updated_at):
+    '''Строгий ETag из id и updated_at: updated_at меняется триггером при любом изменении строки.'''
+    return '"' + hashlib.md5(f'{user_id}:{updated_at.isoformat()}'.encode()).hexdigest() + '"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in (tag[2:] if tag.startswith('W/') else tag for tag in candidates)
@@ -0,0 +1,144 @@
+'''
+Business: Подписанные (HMAC) токены сессий, проверяемые без обращения к БД на каждый запрос
+Args: SESSION_TOKEN_MODE, SESSION_SIGNING_KEYS, REVOCATION_REFRESH_SECONDS из окружения
+Returns: Токен для клиента через issue() и claims (uid, role, iat, exp) через verify()
+'''
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+import db
+
+TOKEN_MODE = os.environ.get('SESSION_TOKEN_MODE', 'opaque')
+REVOCATION_REFRESH_SECONDS = float(os.environ.get('REVOCATION_REFRESH_SECONDS', '5'))
+TOKEN_PREFIX = 'v1.'
+
+
+def _load_keys():
+    '''SESSION_SIGNING_KEYS="kid2:secret2,kid1:secret1": первым ключом подписываем, любым проверяем.'''
+    keys = []
+    for item in os.environ.get('SESSION_SIGNING_KEYS', '').split(','):
+        kid, _, secret = item.strip().partition(':')
+        if kid and secret:
+            keys.append((kid, secret.encode()))
+    return keys
+
+
+SIGNING_KEYS = _load_keys()
+_keys_by_id = dict(SIGNING_KEYS)
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _unb64(value):
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def _sign(kid, payload):
+    return _b64(hmac.new(_keys_by_id[kid], f'{TOKEN_PREFIX}{kid}.{payload}'.encode(), hashlib.sha256).digest())
+
+
+def is_signed(token):
+    return token.startswith(TOKEN_PREFIX)
+
+
+def token_hash(token):
+    return hashlib.md5(token.encode()).hexdigest()
+
+
+def new_session_token():
+    '''Случайный токен сессии; в sessions.token_hash хранится его md5.'''
+    return secrets.token_urlsafe(32)
+
+
+def issue(session_token, user_id, role, expires_at):
+    '''
+    Токен для клиента. В режиме signed — подписанный токен с id пользователя,
+    ролью, сроком и токеном сессии из sessions; иначе — сам токен сессии.
+    Сессия заводится в БД заранее, поэтому выпуск не требует запроса к БД.
+    '''
+    if TOKEN_MODE != 'signed' or not SIGNING_KEYS:
+        return session_token
+
+    kid = SIGNING_KEYS[0][0]
+    claims = {
+        'u': user_id,
+        'r': role,
+        'i': int(time.time() * 1000),
+        'e': int(expires_at.timestamp()),
+        's': session_token
+    }
+    payload = _b64(json.dumps(claims, separators=(',', ':')).encode())
+    return f'{TOKEN_PREFIX}{kid}.{payload}.{_sign(kid, payload)}'
+
+
+class RevocationSet:
+    '''
+    Компактный снимок отзывов: для пользователей — момент, раньше которого
+    выданные токены недействительны (блокировка, смена роли), для отдельных
+    сессий — md5 токенов удалённых до срока сессий. Снимок перечитывается, только
+    когда меняется счётчик auth_revision, а сам счётчик проверяется не чаще
+    раза в REVOCATION_REFRESH_SECONDS.
+    '''
+
+    def __init__(self):
+        self.revision = None
+        self.users = {}
+        self.tokens = set()
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        with db.connection(autocommit=True) as conn, conn.cursor() as cur:
+            cur.execute("SELECT revision FROM auth_revision")
+            row = cur.fetchone()
+            revision = row[0] if row else 0
+            if revision != self.revision:
+                cur.execute("""
+                    SELECT id, tokens_valid_after FROM users
+                    WHERE tokens_valid_after > now() - interval '31 days'
+                """)
+                users = {user_id: valid_after.timestamp() * 1000 for user_id, valid_after in cur.fetchall()}
+                cur.execute("SELECT token_hash FROM session_revocations WHERE expires_at > now()")
+                tokens = {row[0] for row in cur.fetchall()}
+                self.users, self.tokens, self.revision = users, tokens, revision
+        self.checked_at = time.monotonic()
+
+    def is_revoked(self, claims):
+        if time.monotonic() - self.checked_at >= REVOCATION_REFRESH_SECONDS:
+            with self._lock:
+                if time.monotonic() - self.checked_at >= REVOCATION_REFRESH_SECONDS:
+                    self._refresh()
+        valid_after = self.users.get(claims['u'])
+        if valid_after is not None and claims['i'] < valid_after:
+            return True
+        return bool(self.tokens) and token_hash(claims['s']) in self.tokens
+
+
+_revocations = RevocationSet()
+
+
+def verify(token):
+    '''Возвращает claims подписанного токена или None, если он поддельный, истёк или отозван.'''
+    try:
+        kid, payload, signature = token[len(TOKEN_PREFIX):].split('.')
+    except ValueError:
+        return None
+    if kid not in _keys_by_id or not hmac.compare_digest(signature, _sign(kid, payload)):
+        return None
+    try:
+        claims = json.loads(_unb64(payload))
+    except ValueError:
+        return None
+    if claims['e'] <= time.time():
+        return None
+    if _revocations.is_revoked(claims):
+        return None
+    return {'uid': claims['u'], 'role': claims['r'], 'iat': claims['i'] / 1000, 'exp': claims['e']}
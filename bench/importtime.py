@@ -0,0 +1,117 @@
+'''
+Business: Отчёт о времени импорта каждой функции (python -X importtime) с проверкой бюджета холодного старта
+Args: --functions, --repeat, --budget функция=мс (по умолчанию IMPORT_BUDGET_MS), --top
+Returns: Медиану времени импорта index и db, самые дорогие прямые зависимости; код 1 при превышении бюджета
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+# Бюджет в миллисекундах сверх импорта db (psycopg2), замеренного тут же: абсолютное
+# время зависит от машины, а db — общая для всех функций и большая часть импорта.
+# Разброс медианы между запусками — несколько мс, запас бюджета — вдвое больше
+IMPORT_BUDGET_MS = {
+    'user-info': 15,
+    'admin-users': 15,
+    'auth-email': 20,
+    'auth-oauth': 20,
+    'email-sender': 15,
+    'db-maintenance': 15
+}
+REFERENCE_MODULE = 'db'
+
+
+def parse_importtime(stderr, module='index'):
+    '''
+    Строки вида "import time: self | cumulative | <отступ>имя". Возвращает
+    общее время импорта module и его прямые зависимости (первый уровень вложенности).
+    '''
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line.split('|', 2)
+        self_us = int(self_us.replace('import time:', '').strip())
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((depth, name.strip(), self_us, int(cumulative_us.strip())))
+
+    total_us, children = None, {}
+    for i, (depth, name, _, cumulative_us) in enumerate(entries):
+        if depth == 0 and name == module:
+            total_us = cumulative_us
+            # Зависимости модуля стоят перед ним с отступом на уровень глубже
+            j = i - 1
+            while j >= 0 and entries[j][0] > 0:
+                if entries[j][0] == 1:
+                    children[entries[j][1]] = entries[j][3]
+                j -= 1
+    return total_us, children
+
+
+def measure(function, repeat, modules=('index', REFERENCE_MODULE)):
+    '''
+    Каждый замер — свежий интерпретатор в каталоге функции, как при холодном
+    старте. Модули замеряются поочерёдно, чтобы дрейф нагрузки на машине
+    одинаково сдвигал и index, и эталон.
+    '''
+    totals = {module: [] for module in modules}
+    children_runs = []
+    for _ in range(repeat):
+        for module in modules:
+            completed = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                cwd=BACKEND_DIR / function, capture_output=True, text=True,
+                env=dict(os.environ, WARMUP_ON_START='false')
+            )
+            if completed.returncode != 0:
+                raise RuntimeError(f'{function}: {completed.stderr.strip().splitlines()[-1]}')
+            total_us, children = parse_importtime(completed.stderr, module)
+            totals[module].append(total_us)
+            if module == modules[0]:
+                children_runs.append(children)
+
+    names = set().union(*children_runs)
+    children = {name: statistics.median(run.get(name, 0) for run in children_runs) for name in names}
+    return ({module: statistics.median(values) / 1000 for module, values in totals.items()},
+            {name: us / 1000 for name, us in children.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--functions', default=','.join(IMPORT_BUDGET_MS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--budget', action='append', default=[], help='функция=мс')
+    args = parser.parse_args()
+
+    budgets = dict(IMPORT_BUDGET_MS)
+    for item in args.budget:
+        function, _, ms = item.partition('=')
+        budgets[function] = float(ms)
+
+    over_budget = []
+    for function in [f.strip() for f in args.functions.split(',') if f.strip()]:
+        totals, children = measure(function, args.repeat)
+        total_ms, reference_ms = totals['index'], totals[REFERENCE_MODULE]
+        own_ms = total_ms - reference_ms
+        budget = budgets.get(function)
+        verdict = '' if budget is None else ('OK' if own_ms <= budget else 'OVER')
+        print(f'{function}: import index {total_ms:.1f} ms = {REFERENCE_MODULE} {reference_ms:.1f} ms '
+              f'{own_ms:+.1f} ms (budget +{budget} ms) {verdict}')
+        for name, ms in sorted(children.items(), key=lambda item: -item[1])[:args.top]:
+            print(f'    {ms:8.1f} ms  {name}')
+        if verdict == 'OVER':
+            over_budget.append(function)
+
+    if over_budget:
+        print(f"\nFAIL: превышен бюджет импорта: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+Business: Сбор запросов, выполненных функцией под нагрузкой, и проверка их планов через EXPLAIN
+Args: модуль db функции, DSN засеянной БД, таблицы, которым разрешено последовательное чтение
+Returns: План каждого запроса и список последовательных сканирований больших таблиц
+'''
+import json
+
+import psycopg2
+
+# Служебные таблицы из одной строки или вычитываемые целиком по определению
+ALLOWED_SEQ_SCANS = {'auth_revision', 'users_revision', 'user_stats', 'login_events', 'bench_meta'}
+
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+
+class QueryRecorder:
+    '''
+    Запоминает по одному примеру каждого текста запроса с подставленными
+    параметрами. Подменяет execute у курсора из db.py функции только на
+    время бенчмарка.
+    '''
+
+    def __init__(self, db_module):
+        self.samples = {}
+        self._cursor_class = db_module.CountingCursor
+        self._statement_class = db_module.Statement
+        self._original = self._cursor_class.execute
+
+    def install(self):
+        samples, original, statement_class = self.samples, self._original, self._statement_class
+
+        def execute(cursor, query, vars=None):
+            # Для подготовленного запроса объясняется его текст, а не EXECUTE
+            sql = query.sql if isinstance(query, statement_class) else query
+            key = sql if isinstance(sql, str) else sql.as_string(cursor)
+            if key not in samples:
+                samples[key] = cursor.mogrify(sql, vars).decode()
+            return original(cursor, query, vars)
+
+        self._cursor_class.execute = execute
+        return self
+
+    def uninstall(self):
+        self._cursor_class.execute = self._original
+
+
+def seq_scans(plan):
+    '''Таблицы, которые план читает последовательным сканированием.'''
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def explain(dsn, samples, allowed=ALLOWED_SEQ_SCANS):
+    '''
+    EXPLAIN без ANALYZE ничего не выполняет, поэтому безопасен и для
+    INSERT/UPDATE/DELETE. Запросы, которые нельзя объяснить (COMMIT, SET
+    и т.п.), пропускаются.
+    '''
+    results = []
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for query, sql in samples.items():
+                if not sql.lstrip().upper().startswith(EXPLAINABLE):
+                    continue
+                try:
+                    cur.execute('EXPLAIN (FORMAT JSON) ' + sql)
+                except psycopg2.Error as e:
+                    results.append({'query': query, 'error': str(e).strip()})
+                    continue
+                plan = cur.fetchone()[0][0]['Plan']
+                tables = [table for table in seq_scans(plan) if table not in allowed]
+                results.append({'query': query, 'plan': plan, 'seq_scans': tables})
+    finally:
+        conn.close()
+    return results
+
+
+def violations(results):
+    return [result for result in results if result.get('seq_scans')]
+
+
+def dump(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
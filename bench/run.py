@@ -0,0 +1,133 @@
+'''
+Business: Бенчмарк функций backend на локальном PostgreSQL с заглушками reCAPTCHA, OAuth и SMTP
+Args: --dsn сервера, --users объёмы (10k,100k,1m), --functions, --duration, --concurrency, --plans-dir, --compare-prepared
+Returns: Таблицу p50/p95/p99, пропускной способности, обращений к БД и пикового RSS; код 1 при seq scan в плане
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import plans
+import scenarios
+import seed
+from stubs import Stubs
+
+BENCH_DIR = Path(__file__).resolve().parent
+
+DEFAULT_FUNCTIONS = ['user-info', 'admin-users', 'auth-email', 'auth-oauth', 'email-sender']
+
+
+def parse_volume(value):
+    value = value.strip().lower()
+    for suffix, factor in (('k', 1_000), ('m', 1_000_000)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+def run_function(function, dsn, data, stubs, args, extra_env=None):
+    env = dict(os.environ, **stubs.env(), DATABASE_URL=dsn, BENCH_DATA=json.dumps(data),
+               EMAIL_SENDER_SECRET='bench', MAINTENANCE_SECRET='bench', **(extra_env or {}))
+    command = [sys.executable, str(BENCH_DIR / 'worker.py'), function,
+               '--duration', str(args.duration), '--concurrency', str(args.concurrency)]
+    for table in args.allow_seq_scan:
+        command += ['--allow-seq-scan', table]
+    completed = subprocess.run(command, env=env, cwd=BENCH_DIR, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f'{function}: {completed.stderr.strip()}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def format_row(label, stats, rss=''):
+    def cell(value):
+        return '-' if value is None else f'{value:g}' if isinstance(value, (int, float)) else str(value)
+    return (f"  {label:<28} {cell(stats['requests']):>8} {cell(stats['throughput']):>9} "
+            f"{cell(stats['p50_ms']):>9} {cell(stats['p95_ms']):>9} {cell(stats['p99_ms']):>9} "
+            f"{cell(stats['round_trips_avg']):>6} {cell(stats['round_trips_max']):>5} {rss:>8}")
+
+
+def report(volume, result, variant=None):
+    label = f" [{variant}]" if variant else ''
+    print(f"\n{result['function']}{label} @ {volume} users: import {result['import_ms']} ms, "
+          f"cold {json.dumps(result['cold_ms'])}, prepared {json.dumps(result['prepared'])}")
+    print(f"  {'event':<28} {'requests':>8} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'rt avg':>6} {'rt max':>5} {'rss MB':>8}")
+    latency = result['latency']
+    print(format_row('total', latency['total'], str(result['peak_rss_mb'])))
+    for name, stats in latency.items():
+        if name != 'total':
+            print(format_row(name, stats))
+    for item in plans.violations(result['plans']):
+        print(f"  SEQ SCAN on {', '.join(item['seq_scans'])}: {' '.join(item['query'].split())[:160]}")
+    for item in result['plans']:
+        if item.get('error'):
+            print(f"  EXPLAIN failed: {item['error']}: {' '.join(item['query'].split())[:120]}")
+
+
+def compare_prepared(plain, prepared):
+    '''Разница p50 по событиям между прогоном без подготовленных запросов и с ними.'''
+    print(f"  {'prepared vs plain':<28} {'p50 plain':>10} {'p50 prep':>10} {'delta ms':>9}")
+    for name, stats in prepared['latency'].items():
+        before, after = plain['latency'][name]['p50_ms'], stats['p50_ms']
+        if before is None or after is None:
+            continue
+        print(f"  {name:<28} {before:>10g} {after:>10g} {round(after - before, 3):>9g}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DATABASE_URL') or os.environ.get('DATABASE_URL'))
+    parser.add_argument('--database', default='bench', help='префикс имени БД для засеянных данных')
+    parser.add_argument('--users', default='10k', help='объёмы через запятую: 10k,100k,1m')
+    parser.add_argument('--sessions-per-user', type=int, default=1)
+    parser.add_argument('--functions', default=','.join(DEFAULT_FUNCTIONS))
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--plans-dir', help='куда сохранить планы запросов в JSON')
+    parser.add_argument('--allow-seq-scan', action='append', default=[], help='таблица, которой разрешён seq scan')
+    parser.add_argument('--compare-prepared', action='store_true',
+                        help='прогнать каждую функцию без подготовленных запросов и с ними')
+    args = parser.parse_args()
+
+    if not args.dsn:
+        parser.error('нужен --dsn или BENCH_DATABASE_URL')
+
+    functions = [f.strip() for f in args.functions.split(',') if f.strip()]
+    unknown = [f for f in functions if f not in scenarios.SCENARIOS]
+    if unknown:
+        parser.error(f'нет сценария для {", ".join(unknown)}')
+
+    stubs = Stubs().start()
+    failed = False
+    try:
+        for volume in (parse_volume(v) for v in args.users.split(',')):
+            dsn, data = seed.prepare(args.dsn, f'{args.database}_{volume}', volume,
+                                     args.sessions_per_user, reseed=args.reseed)
+            for function in functions:
+                if args.compare_prepared:
+                    plain = run_function(function, dsn, data, stubs, args, {'DB_PREPARED_STATEMENTS': 'false'})
+                    report(volume, plain, 'plain')
+                    result = run_function(function, dsn, data, stubs, args, {'DB_PREPARED_STATEMENTS': 'true'})
+                    report(volume, result, 'prepared')
+                    compare_prepared(plain, result)
+                else:
+                    result = run_function(function, dsn, data, stubs, args)
+                    report(volume, result)
+                if args.plans_dir:
+                    Path(args.plans_dir).mkdir(parents=True, exist_ok=True)
+                    plans.dump(result['plans'], Path(args.plans_dir) / f'{function}-{volume}.json')
+                failed = failed or bool(plans.violations(result['plans']))
+    finally:
+        stubs.stop()
+
+    if failed:
+        print('\nFAIL: в планах есть последовательное сканирование больших таблиц')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+Business: Смеси событий для бенчмарка по каждой функции, близкие к реальному трафику
+Args: rng - генератор случайных чисел, data - описание засеянных данных из seed.describe()
+Returns: События в формате облачной функции и доли запросов каждого вида
+'''
+import base64
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+
+
+def user_token(rng, data):
+    user_id = rng.randint(data['first_id'], data['last_id'])
+    return f"bench-{user_id}-{rng.randint(1, data['sessions_per_user'])}"
+
+
+def user_email(rng, data):
+    return f"user{rng.randint(1, data['users'])}@bench.local"
+
+
+def http_event(method, headers=None, body=None, query=None):
+    event = {'httpMethod': method, 'headers': headers or {}, 'queryStringParameters': query or {}}
+    if body is not None:
+        event['body'] = json.dumps(body)
+    return event
+
+
+def user_info_valid(rng, data):
+    return http_event('GET', {'X-Auth-Token': user_token(rng, data)})
+
+
+def user_info_unknown(rng, data):
+    return http_event('GET', {'X-Auth-Token': f'unknown-{rng.randint(1, 1000)}'})
+
+
+def admin_list_first_page(rng, data):
+    return http_event('GET', {'X-Auth-Token': data['admin_token']}, query={'limit': '50'})
+
+
+def admin_list_filtered(rng, data):
+    query = rng.choice([{'status': 'blocked'}, {'role': 'admin'}, {'provider': 'yandex'}, {'status': 'muted'}])
+    return http_event('GET', {'X-Auth-Token': data['admin_token']}, query=dict(query, limit='50'))
+
+
+def admin_list_deep_page(rng, data):
+    # Курсор на середину таблицы: created_at засеян с шагом 30 секунд от конца
+    offset = rng.randint(1, data['users'] - 1)
+    created_at = datetime.now() - timedelta(seconds=offset * 30)
+    raw = json.dumps([created_at.isoformat(), data['last_id'] - offset]).encode()
+    cursor = base64.urlsafe_b64encode(raw).decode().rstrip('=')
+    return http_event('GET', {'X-Auth-Token': data['admin_token']}, query={'limit': '50', 'cursor': cursor})
+
+
+def admin_moderate(rng, data):
+    user_id = rng.randint(data['first_id'], data['last_id'])
+    action = rng.choice(['mute', 'unmute'])
+    return http_event('PUT', {'X-Auth-Token': data['admin_token']}, {'userId': user_id, 'action': action})
+
+
+def email_login(rng, data):
+    return http_event('POST', body={'action': 'login', 'email': user_email(rng, data),
+                                    'password': data['password'], 'recaptchaToken': 'bench'})
+
+
+def email_login_wrong_password(rng, data):
+    return http_event('POST', body={'action': 'login', 'email': user_email(rng, data),
+                                    'password': 'wrong-password', 'recaptchaToken': 'bench'})
+
+
+def email_register(rng, data):
+    return http_event('POST', body={'action': 'register', 'email': f'reg-{uuid.uuid4().hex}@bench.local',
+                                    'password': data['password'], 'recaptchaToken': 'bench'})
+
+
+def email_verify(rng, data):
+    # Неподтверждённые пользователи засеяны с номерами, оканчивающимися на 9
+    number = rng.randint(0, max(data['users'] // 10 - 1, 0)) * 10 + 9
+    return http_event('POST', body={'action': 'verify', 'email': f'user{number}@bench.local',
+                                    'code': data['verification_code']})
+
+
+def oauth_callback(rng, data):
+    # Каждый десятый вход — новый пользователь, остальные — засеянные через yandex
+    if rng.random() < 0.1:
+        code = f'new-{uuid.uuid4().hex}'
+    else:
+        code = f"bench-{rng.randint(1, max(data['users'] // 5, 1)) * 5}"
+    return http_event('GET', query={'provider': 'yandex', 'code': code})
+
+
+def sender_tick(rng, data):
+    return {'event_type': 'timer'}
+
+
+def use_oauth_stub(module):
+    '''Провайдер yandex отвечает с локальной заглушки вместо oauth.yandex.ru.'''
+    base_url = os.environ['BENCH_OAUTH_URL']
+    config = module.PROVIDERS_CONFIG['yandex']
+    config['token_url'] = f'{base_url}/token'
+    config['user_info_url'] = f'{base_url}/userinfo'
+
+
+# Функция -> (подготовка модуля, [(доля, имя, фабрика события)])
+SCENARIOS = {
+    'user-info': (None, [
+        (0.95, 'valid_token', user_info_valid),
+        (0.05, 'unknown_token', user_info_unknown)
+    ]),
+    'admin-users': (None, [
+        (0.4, 'first_page', admin_list_first_page),
+        (0.3, 'filtered', admin_list_filtered),
+        (0.2, 'deep_page', admin_list_deep_page),
+        (0.1, 'moderate', admin_moderate)
+    ]),
+    'auth-email': (None, [
+        (0.7, 'login', email_login),
+        (0.1, 'login_wrong_password', email_login_wrong_password),
+        (0.1, 'register', email_register),
+        (0.1, 'verify', email_verify)
+    ]),
+    'auth-oauth': (use_oauth_stub, [
+        (1.0, 'callback', oauth_callback)
+    ]),
+    'email-sender': (None, [
+        (1.0, 'drain', sender_tick)
+    ])
+}
+
+
+def pick(rng, mix):
+    point = rng.random() * sum(weight for weight, _, _ in mix)
+    for weight, name, factory in mix:
+        point -= weight
+        if point <= 0:
+            return name, factory
+    return mix[-1][1], mix[-1][2]
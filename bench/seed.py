@@ -0,0 +1,158 @@
+'''
+Business: Подготовка отдельной БД для бенчмарка: миграции из db_migrations и синтетические данные нужного объёма
+Args: DSN сервера PostgreSQL, имя БД, число пользователей и сессий на пользователя
+Returns: DSN подготовленной БД и описание данных (диапазон id, токен админа, пароль)
+'''
+import os
+import sys
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+import psycopg2
+
+ROOT = Path(__file__).resolve().parent.parent
+MIGRATIONS_DIR = ROOT / 'db_migrations'
+
+BENCH_PASSWORD = 'bench-password'
+ADMIN_TOKEN = 'bench-admin-token'
+VERIFICATION_CODE = '123456'
+
+
+def database_dsn(server_dsn, name):
+    '''Тот же сервер и учётные данные, но другая БД.'''
+    parts = urlsplit(server_dsn)
+    return urlunsplit(parts._replace(path='/' + name))
+
+
+def password_hash():
+    '''Хэш пароля считается тем же модулем, что и в auth-email, чтобы вход шёл по реальной стоимости.'''
+    sys.path.insert(0, str(ROOT / 'backend' / 'auth-email'))
+    try:
+        import passwords
+        return passwords.hash_password(BENCH_PASSWORD)
+    finally:
+        sys.path.pop(0)
+
+
+def apply_migrations(cur):
+    for path in sorted(MIGRATIONS_DIR.glob('V*__*.sql'), key=lambda p: int(p.name[1:].split('__')[0])):
+        cur.execute(path.read_text())
+
+
+def describe(cur):
+    cur.execute("SELECT users, sessions_per_user FROM bench_meta")
+    users, sessions_per_user = cur.fetchone()
+    cur.execute("SELECT min(id), max(id) FROM users WHERE email LIKE '%@bench.local'")
+    first_id, last_id = cur.fetchone()
+    return {
+        'users': users,
+        'sessions_per_user': sessions_per_user,
+        'first_id': first_id,
+        'last_id': last_id,
+        'admin_token': ADMIN_TOKEN,
+        'password': BENCH_PASSWORD,
+        'verification_code': VERIFICATION_CODE
+    }
+
+
+def seed(cur, users, sessions_per_user):
+    '''
+    Распределения примерно как в проде: 10% не подтвердили email, 2% заблокированы,
+    ~1.4% в муте, треть пришла через OAuth, 5% сессий уже истекли. Токены
+    сессий детерминированы (bench-<user_id>-<n>, в БД — их md5), чтобы
+    нагрузка строила их без запросов.
+    '''
+    cur.execute("""
+        INSERT INTO users (email, name, password_hash, role, status, provider, provider_id,
+                           email_verified, created_at, last_login)
+        SELECT 'user' || g || '@bench.local',
+               'User ' || g,
+               CASE WHEN g %% 5 = 0 OR g %% 7 = 0 THEN NULL ELSE %(hash)s END,
+               CASE WHEN g %% 1000 = 0 THEN 'admin' ELSE 'user' END,
+               CASE WHEN g %% 50 = 0 THEN 'blocked' WHEN g %% 70 = 0 THEN 'muted' ELSE 'active' END,
+               CASE WHEN g %% 5 = 0 THEN 'yandex' WHEN g %% 7 = 0 THEN 'google' END,
+               CASE WHEN g %% 5 = 0 OR g %% 7 = 0 THEN 'bench-' || g END,
+               g %% 10 <> 9,
+               now() - make_interval(secs => (%(users)s - g) * 30),
+               CASE WHEN g %% 3 = 0 THEN NULL ELSE now() - make_interval(secs => g %% 86400) END
+        FROM generate_series(1, %(users)s) AS g
+    """, {'hash': password_hash(), 'users': users})
+
+    cur.execute("""
+        INSERT INTO sessions (user_id, token_hash, expires_at)
+        SELECT u.id, md5('bench-' || u.id || '-' || n)::uuid,
+               CASE WHEN (u.id + n) %% 20 = 0 THEN now() - interval '1 day' ELSE now() + interval '30 days' END
+        FROM users u CROSS JOIN generate_series(1, %s) AS n
+        WHERE u.email LIKE '%%@bench.local'
+    """, (sessions_per_user,))
+
+    cur.execute("""
+        INSERT INTO sessions (user_id, token_hash, expires_at)
+        SELECT id, md5(%s)::uuid, now() + interval '365 days' FROM users WHERE email = 'pozlite@example.com'
+    """, (ADMIN_TOKEN,))
+
+    cur.execute("""
+        INSERT INTO email_verifications (email, code, expires_at)
+        SELECT email, %s, now() + interval '1 day' FROM users
+        WHERE NOT email_verified AND email LIKE '%%@bench.local'
+    """, (VERIFICATION_CODE,))
+
+    cur.execute("""
+        INSERT INTO email_outbox (recipient, template, payload)
+        SELECT 'user' || g || '@bench.local', 'verification', jsonb_build_object('code', %s)
+        FROM generate_series(1, greatest(%s / 10, 1)) AS g
+    """, (VERIFICATION_CODE, users))
+
+    cur.execute("CREATE TABLE bench_meta (users INTEGER NOT NULL, sessions_per_user INTEGER NOT NULL)")
+    cur.execute("INSERT INTO bench_meta VALUES (%s, %s)", (users, sessions_per_user))
+
+
+def prepare(server_dsn, name, users, sessions_per_user=1, reseed=False):
+    '''Создаёт БД заново, если её нет, объём данных другой или передан reseed.'''
+    dsn = database_dsn(server_dsn, name)
+
+    admin = psycopg2.connect(server_dsn)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (name,))
+        exists = cur.fetchone() is not None
+
+    if exists and not reseed:
+        conn = psycopg2.connect(dsn)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass('bench_meta') IS NOT NULL")
+                if cur.fetchone()[0]:
+                    info = describe(cur)
+                    if (info['users'], info['sessions_per_user']) == (users, sessions_per_user):
+                        return dsn, info
+        finally:
+            conn.close()
+
+    with admin.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{name}"')
+        cur.execute(f'CREATE DATABASE "{name}"')
+    admin.close()
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            apply_migrations(cur)
+            seed(cur, users, sessions_per_user)
+        conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("VACUUM ANALYZE")
+            info = describe(cur)
+    finally:
+        conn.close()
+    return dsn, info
+
+
+if __name__ == '__main__':
+    # python bench/seed.py <dsn сервера> <имя БД> <пользователей> [сессий на пользователя]
+    server_dsn = sys.argv[1] if len(sys.argv) > 1 else os.environ['DATABASE_URL']
+    name = sys.argv[2] if len(sys.argv) > 2 else 'bench'
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 10_000
+    sessions_per_user = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    print(prepare(server_dsn, name, users, sessions_per_user, reseed=True))
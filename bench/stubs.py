@@ -0,0 +1,124 @@
+'''
+Business: Локальные заглушки внешних сервисов для бенчмарка: reCAPTCHA, OAuth-провайдер и SMTP
+Args: STUB_LATENCY_MS - искусственная задержка ответа HTTP-заглушек
+Returns: Запущенные в фоновых потоках серверы с адресами и счётчиками запросов
+'''
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+STUB_LATENCY_MS = float(os.environ.get('STUB_LATENCY_MS', '0'))
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    '''
+    /recaptcha — всегда успешная проверка; /oauth/token отдаёт access_token,
+    равный коду; /oauth/userinfo возвращает пользователя с id из токена, так
+    что набор кодов в нагрузке задаёт долю новых и повторных входов.
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _reply(self, payload, status=200):
+        if STUB_LATENCY_MS:
+            time.sleep(STUB_LATENCY_MS / 1000)
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.counts[self.path.split('?')[0]] = self.server.counts.get(self.path.split('?')[0], 0) + 1
+
+    def _form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+
+    def do_POST(self):
+        form = self._form()
+        if self.path.startswith('/recaptcha'):
+            self._reply({'success': True, 'score': 0.9})
+        elif self.path.startswith('/oauth/token'):
+            self._reply({'access_token': form.get('code', ''), 'token_type': 'bearer'})
+        else:
+            self._reply({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        if self.path.startswith('/oauth/userinfo'):
+            code = self.headers.get('Authorization', '').split(' ')[-1]
+            self._reply({'id': code, 'default_email': f'{code}@oauth.bench', 'display_name': code})
+        else:
+            self._reply({'error': 'not found'}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    '''Минимальный SMTP-приёмник: принимает всё и только считает письма.'''
+    disable_nagle_algorithm = True
+
+    def _send(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self._send('220 bench ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self._send('250 bench')
+            elif command == 'DATA':
+                self._send('354 end with .')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                self.server.messages += 1
+                self._send('250 queued')
+            elif command == 'QUIT':
+                self._send('221 bye')
+                return
+            else:
+                self._send('250 ok')
+
+
+class ThreadingSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    messages = 0
+
+
+class Stubs:
+    def __init__(self, host='127.0.0.1'):
+        self.http = ThreadingHTTPServer((host, 0), UpstreamHandler)
+        self.http.daemon_threads = True
+        self.http.counts = {}
+        self.smtp = ThreadingSmtpServer((host, 0), SmtpHandler)
+        self.base_url = f'http://{host}:{self.http.server_address[1]}'
+        self.smtp_host, self.smtp_port = host, self.smtp.server_address[1]
+
+    def start(self):
+        for server in (self.http, self.smtp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        for server in (self.http, self.smtp):
+            server.shutdown()
+            server.server_close()
+
+    def env(self):
+        '''Переменные окружения, направляющие функции на заглушки.'''
+        return {
+            'RECAPTCHA_VERIFY_URL': f'{self.base_url}/recaptcha',
+            'BENCH_OAUTH_URL': f'{self.base_url}/oauth',
+            'SMTP_HOST': self.smtp_host,
+            'SMTP_PORT': str(self.smtp_port),
+            'SMTP_STARTTLS': 'false',
+            'SMTP_FROM': 'bench@bench.local'
+        }
@@ -0,0 +1,133 @@
+'''
+Business: Прогон одной функции под нагрузкой в отдельном процессе, чтобы пул, кэши и пиковая память были её собственными
+Args: имя функции, длительность, число потоков; DATABASE_URL и адреса заглушек в окружении, описание данных в BENCH_DATA
+Returns: JSON в stdout: задержки p50/p95/p99, пропускная способность, обращения к БД, пиковый RSS и планы запросов
+'''
+import argparse
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+import plans
+import scenarios
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+
+def load_handler(function):
+    '''Импортирует index.py функции так же, как платформа: её каталог первым в sys.path.'''
+    function_dir = BACKEND_DIR / function
+    sys.path.insert(0, str(function_dir))
+    spec = importlib.util.spec_from_file_location('index', function_dir / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples, elapsed):
+    latencies = [ms for ms, _, _ in samples]
+    trips = [rt for _, _, rt in samples if rt is not None]
+    statuses = {}
+    for _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(samples),
+        'throughput': round(len(samples) / elapsed, 1) if elapsed else None,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'round_trips_avg': round(sum(trips) / len(trips), 2) if trips else None,
+        'round_trips_max': max(trips) if trips else None,
+        'statuses': statuses
+    }
+
+
+def run(module, mix, data, duration, concurrency, seed):
+    samples = {name: [] for _, name, _ in mix}
+    stop_at = time.monotonic() + duration
+
+    def loop(worker_id):
+        rng = random.Random(seed + worker_id)
+        while time.monotonic() < stop_at:
+            name, factory = scenarios.pick(rng, mix)
+            event = factory(rng, data)
+            started = time.perf_counter()
+            response = module.handler(event, None)
+            elapsed_ms = round((time.perf_counter() - started) * 1000, 3)
+            trips = (response.get('headers') or {}).get('X-DB-Round-Trips')
+            samples[name].append((elapsed_ms, response.get('statusCode'), int(trips) if trips else None))
+
+    threads = [threading.Thread(target=loop, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    result = {'total': summarize([s for values in samples.values() for s in values], elapsed)}
+    for name, values in samples.items():
+        result[name] = summarize(values, elapsed)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('function')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--allow-seq-scan', action='append', default=[])
+    args = parser.parse_args()
+
+    data = json.loads(os.environ['BENCH_DATA'])
+    setup, mix = scenarios.SCENARIOS[args.function]
+
+    import_started = time.perf_counter()
+    module = load_handler(args.function)
+    import_ms = round((time.perf_counter() - import_started) * 1000, 3)
+    if setup:
+        setup(module)
+
+    recorder = plans.QueryRecorder(sys.modules['db']).install()
+
+    # Первый вызов каждого вида — холодный: соединение с БД, TLS-сессии, калибровка хэша
+    rng = random.Random(args.seed)
+    cold = {}
+    for _, name, factory in mix:
+        started = time.perf_counter()
+        module.handler(factory(rng, data), None)
+        cold[name] = round((time.perf_counter() - started) * 1000, 3)
+
+    result = run(module, mix, data, args.duration, args.concurrency, args.seed)
+    recorder.uninstall()
+
+    explained = plans.explain(os.environ['DATABASE_URL'], recorder.samples,
+                              plans.ALLOWED_SEQ_SCANS | set(args.allow_seq_scan))
+
+    print(json.dumps({
+        'function': args.function,
+        'import_ms': import_ms,
+        'cold_ms': cold,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'latency': result,
+        'prepared': sys.modules['db'].prepared_stats(),
+        'plans': explained
+    }, default=str))
+
+
+if __name__ == '__main__':
+    main()
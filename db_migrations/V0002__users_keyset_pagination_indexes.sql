@@ -0,0 +1,8 @@
+-- created_at участвует в ключе пагинации, поэтому не может быть NULL
+UPDATE users SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE users ALTER COLUMN created_at SET NOT NULL;
+
+-- Индексы для keyset-пагинации списка пользователей в админке
+CREATE INDEX IF NOT EXISTS idx_users_created_id ON users(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_users_status_created_id ON users(status, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_users_provider_created_id ON users(provider, created_at, id);
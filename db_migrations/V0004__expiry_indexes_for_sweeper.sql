@@ -0,0 +1,4 @@
+-- Индексы для пакетной очистки устаревших строк функцией db-maintenance
+CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions(expires_at);
+CREATE INDEX IF NOT EXISTS idx_email_verifications_expires_at ON email_verifications(expires_at);
+CREATE INDEX IF NOT EXISTS idx_email_outbox_sent_at ON email_outbox(sent_at) WHERE status = 'sent';
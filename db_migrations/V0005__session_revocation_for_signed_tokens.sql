@@ -0,0 +1,54 @@
+-- Отзыв подписанных токенов: источником истины остаются users и sessions,
+-- триггеры только поддерживают компактный набор отзывов и счётчик изменений
+ALTER TABLE users ADD COLUMN IF NOT EXISTS tokens_valid_after TIMESTAMPTZ;
+
+CREATE TABLE IF NOT EXISTS session_revocations (
+    token_hash CHAR(32) PRIMARY KEY,
+    user_id INTEGER,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS auth_revision (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE,
+    revision BIGINT NOT NULL DEFAULT 0,
+    CONSTRAINT auth_revision_single_row CHECK (id)
+);
+
+INSERT INTO auth_revision (id, revision) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING;
+
+CREATE INDEX IF NOT EXISTS idx_users_tokens_valid_after ON users(tokens_valid_after) WHERE tokens_valid_after IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_session_revocations_expires_at ON session_revocations(expires_at);
+
+-- Блокировка или смена роли делает недействительными ранее выданные токены
+CREATE OR REPLACE FUNCTION users_revoke_tokens() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status IS DISTINCT FROM OLD.status OR NEW.role IS DISTINCT FROM OLD.role THEN
+        NEW.tokens_valid_after := clock_timestamp();
+        UPDATE auth_revision SET revision = revision + 1;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_revoke_tokens ON users;
+CREATE TRIGGER trg_users_revoke_tokens
+    BEFORE UPDATE OF status, role ON users
+    FOR EACH ROW EXECUTE FUNCTION users_revoke_tokens();
+
+-- Удаление ещё не истёкшей сессии (выход) отзывает её токен
+CREATE OR REPLACE FUNCTION sessions_revoke_token() RETURNS trigger AS $$
+BEGIN
+    IF OLD.expires_at > now() THEN
+        INSERT INTO session_revocations (token_hash, user_id, expires_at)
+        VALUES (md5(OLD.token), OLD.user_id, OLD.expires_at)
+        ON CONFLICT (token_hash) DO NOTHING;
+        UPDATE auth_revision SET revision = revision + 1;
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_sessions_revoke_token ON sessions;
+CREATE TRIGGER trg_sessions_revoke_token
+    AFTER DELETE ON sessions
+    FOR EACH ROW EXECUTE FUNCTION sessions_revoke_token();
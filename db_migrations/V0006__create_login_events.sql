@@ -0,0 +1,7 @@
+-- Журнал входов для отложенной записи users.last_login (LAST_LOGIN_MODE=table):
+-- только дописывается, без индексов и внешних ключей, чтобы вход не трогал
+-- строку пользователя; db-maintenance переносит последние значения в users
+CREATE TABLE IF NOT EXISTS login_events (
+    user_id INTEGER NOT NULL,
+    logged_in_at TIMESTAMP NOT NULL
+);
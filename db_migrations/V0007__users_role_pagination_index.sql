@@ -0,0 +1,3 @@
+-- Фильтр по роли в списке пользователей админки читал всю таблицу
+-- (найдено бенчмарком bench/run.py по планам запросов)
+CREATE INDEX IF NOT EXISTS idx_users_role_created_id ON users(role, created_at, id);
@@ -0,0 +1,52 @@
+-- Версии данных пользователей для ETag: updated_at строки и счётчик изменений таблицы
+UPDATE users SET updated_at = COALESCE(last_login, created_at) WHERE updated_at IS NULL;
+ALTER TABLE users ALTER COLUMN updated_at SET NOT NULL;
+
+CREATE TABLE IF NOT EXISTS users_revision (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE,
+    revision BIGINT NOT NULL DEFAULT 0,
+    CONSTRAINT users_revision_single_row CHECK (id)
+);
+
+INSERT INTO users_revision (id, revision) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING;
+
+-- updated_at меняется при любом изменении строки. Индекса на колонке нет,
+-- поэтому обновления last_login остаются HOT
+CREATE OR REPLACE FUNCTION users_touch_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_touch_updated_at ON users;
+CREATE TRIGGER trg_users_touch_updated_at
+    BEFORE UPDATE ON users
+    FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION users_touch_updated_at();
+
+-- Счётчик растёт на каждый оператор, затронувший хотя бы одну строку users;
+-- пустые UPDATE (например, повторная блокировка) его не трогают
+CREATE OR REPLACE FUNCTION users_bump_revision() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM changed_rows) THEN
+        UPDATE users_revision SET revision = revision + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_revision_insert ON users;
+CREATE TRIGGER trg_users_revision_insert
+    AFTER INSERT ON users REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_bump_revision();
+
+DROP TRIGGER IF EXISTS trg_users_revision_update ON users;
+CREATE TRIGGER trg_users_revision_update
+    AFTER UPDATE ON users REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_bump_revision();
+
+DROP TRIGGER IF EXISTS trg_users_revision_delete ON users;
+CREATE TRIGGER trg_users_revision_delete
+    AFTER DELETE ON users REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_bump_revision();
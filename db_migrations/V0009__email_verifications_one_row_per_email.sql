@@ -0,0 +1,14 @@
+-- Один действующий код на email: новый код заменяет старый через ON CONFLICT (email),
+-- подтверждение ищет по первичному ключу и удаляет код после успеха
+DELETE FROM email_verifications v
+USING email_verifications newer
+WHERE newer.email = v.email
+  AND (COALESCE(newer.created_at, 'epoch'), newer.id) > (COALESCE(v.created_at, 'epoch'), v.id);
+
+ALTER TABLE email_verifications DROP COLUMN IF EXISTS id;
+ALTER TABLE email_verifications DROP CONSTRAINT IF EXISTS email_verifications_pkey;
+ALTER TABLE email_verifications ADD CONSTRAINT email_verifications_pkey PRIMARY KEY (email);
+ALTER TABLE email_verifications ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+
+-- Поиск по email теперь идёт по первичному ключу
+DROP INDEX IF EXISTS idx_email_verifications_email;
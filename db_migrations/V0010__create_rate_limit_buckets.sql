@@ -0,0 +1,12 @@
+-- Общие корзины ограничения частоты для auth-email (RATE_LIMIT_STORE=postgres).
+-- UNLOGGED: не пишется в WAL и обнуляется после сбоя — для лимитов это допустимо
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    per_second DOUBLE PRECISION NOT NULL,
+    allowed BOOLEAN NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL
+);
+
+-- Для удаления давно не использованных корзин функцией db-maintenance
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated_at ON rate_limit_buckets(updated_at);
@@ -0,0 +1,22 @@
+-- Сводка для дашборда админки: читается за постоянное время, пересчитывается
+-- функцией db-maintenance (REFRESH MATERIALIZED VIEW CONCURRENTLY)
+CREATE MATERIALIZED VIEW IF NOT EXISTS user_stats AS
+SELECT 'total' AS dimension, '' AS key, count(*) AS value FROM users
+UNION ALL
+SELECT 'status', status, count(*) FROM users GROUP BY status
+UNION ALL
+SELECT 'role', role, count(*) FROM users GROUP BY role
+UNION ALL
+SELECT 'provider', COALESCE(provider, 'email'), count(*) FROM users GROUP BY COALESCE(provider, 'email')
+UNION ALL
+-- Регистрации и входы (каждый вход создаёт сессию) за последние 90 дней
+SELECT 'signups', to_char(created_at::date, 'YYYY-MM-DD'), count(*) FROM users
+WHERE created_at >= current_date - 89 GROUP BY created_at::date
+UNION ALL
+SELECT 'logins', to_char(created_at::date, 'YYYY-MM-DD'), count(*) FROM sessions
+WHERE created_at >= current_date - 89 GROUP BY created_at::date
+UNION ALL
+SELECT 'refreshed_at', '', extract(epoch FROM now())::bigint;
+
+-- Уникальный индекс нужен для REFRESH ... CONCURRENTLY: чтение не блокируется на время пересчёта
+CREATE UNIQUE INDEX IF NOT EXISTS idx_user_stats_dimension_key ON user_stats(dimension, key);
@@ -0,0 +1,30 @@
+-- Сессия ищется по md5 токена вместо VARCHAR(255): uuid — 16 байт фиксированной
+-- ширины. Уникальный индекс по хэшу несёт user_id и expires_at (INCLUDE), так что
+-- проверка токена читает sessions только из индекса (Index Only Scan).
+-- Сам токен в БД больше не хранится
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS token_hash UUID;
+UPDATE sessions SET token_hash = md5(token)::uuid WHERE token_hash IS NULL;
+ALTER TABLE sessions ALTER COLUMN token_hash SET NOT NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_token_hash ON sessions(token_hash) INCLUDE (user_id, expires_at);
+
+-- В session_revocations по-прежнему md5 токена в hex, как signed_tokens.token_hash()
+CREATE OR REPLACE FUNCTION sessions_revoke_token() RETURNS trigger AS $$
+BEGIN
+    IF OLD.expires_at > now() THEN
+        INSERT INTO session_revocations (token_hash, user_id, expires_at)
+        VALUES (replace(OLD.token_hash::text, '-', ''), OLD.user_id, OLD.expires_at)
+        ON CONFLICT (token_hash) DO NOTHING;
+        UPDATE auth_revision SET revision = revision + 1;
+    END IF;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Вместе с колонкой уходит и её UNIQUE-индекс sessions_token_key
+DROP INDEX IF EXISTS idx_sessions_token;
+ALTER TABLE sessions DROP COLUMN IF EXISTS token;
+
+-- Дублировали индексы UNIQUE-ограничений users_email_key и users_provider_provider_id_key
+DROP INDEX IF EXISTS idx_users_email;
+DROP INDEX IF EXISTS idx_users_provider;
@@ -0,0 +1,24 @@
+-- users_revision поднимался любым UPDATE users, в том числе last_login на каждом
+-- входе: все входы вставали в очередь за блокировкой одной строки счётчика.
+-- Теперь UPDATE поднимает его, только если изменилось поле, которое видно в
+-- списке админки. Свежесть lastLogin в списке ограничена по времени
+-- (LIST_LAST_LOGIN_MAX_AGE в admin-users). INSERT и DELETE поднимают счётчик как раньше.
+-- Список колонок (AFTER UPDATE OF ...) с таблицами переходов несовместим,
+-- поэтому старые и новые значения сравниваются в самой функции
+CREATE OR REPLACE FUNCTION users_bump_revision_on_update() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.email, n.name, n.avatar_url, n.role, n.status, n.provider)
+              IS DISTINCT FROM (o.email, o.name, o.avatar_url, o.role, o.status, o.provider)
+    ) THEN
+        UPDATE users_revision SET revision = revision + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_revision_update ON users;
+CREATE TRIGGER trg_users_revision_update
+    AFTER UPDATE ON users REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_bump_revision_on_update();
@@ -0,0 +1,37 @@
+-- Входы по дням для сводки user_stats. Раньше их считали по sessions, но сессия
+-- живёт 30 дней и удаляется через SESSION_RETENTION_DAYS после истечения, так что
+-- дни старше ~37 дней в 90-дневном ряду молча обнулялись. db-maintenance
+-- пересчитывает последние 30 дней (их сессии ещё все на месте), а более старые дни
+-- остаются с последним посчитанным значением. Запросы входа эту таблицу не трогают
+CREATE TABLE IF NOT EXISTS login_days (
+    day DATE PRIMARY KEY,
+    logins INTEGER NOT NULL
+);
+
+INSERT INTO login_days (day, logins)
+SELECT created_at::date, count(*) FROM sessions
+WHERE created_at >= current_date - 29
+GROUP BY created_at::date
+ON CONFLICT (day) DO UPDATE SET logins = EXCLUDED.logins;
+
+DROP MATERIALIZED VIEW IF EXISTS user_stats;
+
+CREATE MATERIALIZED VIEW user_stats AS
+SELECT 'total' AS dimension, '' AS key, count(*) AS value FROM users
+UNION ALL
+SELECT 'status', status, count(*) FROM users GROUP BY status
+UNION ALL
+SELECT 'role', role, count(*) FROM users GROUP BY role
+UNION ALL
+SELECT 'provider', COALESCE(provider, 'email'), count(*) FROM users GROUP BY COALESCE(provider, 'email')
+UNION ALL
+-- Регистрации и входы за последние 90 дней
+SELECT 'signups', to_char(created_at::date, 'YYYY-MM-DD'), count(*) FROM users
+WHERE created_at >= current_date - 89 GROUP BY created_at::date
+UNION ALL
+SELECT 'logins', to_char(day, 'YYYY-MM-DD'), logins::bigint FROM login_days
+WHERE day >= current_date - 89
+UNION ALL
+SELECT 'refreshed_at', '', extract(epoch FROM now())::bigint;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_user_stats_dimension_key ON user_stats(dimension, key);
@@ -0,0 +1,340 @@
+'''
+Business: Шлюз для self-hosted запуска: все функции из backend/func2url.json в одном процессе за одним HTTP-портом
+Args: --host, --port, --workers, --queue, --route-limit функция=N, --route-wait, --timer функция=сек, --trust-forwarded, --grace
+Returns: HTTP-сервер, переводящий запросы /<функция>/... в event для handler(event, context)
+'''
+import argparse
+import base64
+import hashlib
+import importlib.util
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+class GatewayError(Exception):
+    pass
+
+
+class InvocationContext:
+    '''Минимальный context облачной функции: имя функции и id запроса.'''
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.request_id = uuid.uuid4().hex
+
+
+class Route:
+    def __init__(self, name, handler, limit):
+        self.name = name
+        self.handler = handler
+        self.limit = limit
+        self.slots = threading.BoundedSemaphore(limit)
+        self.stats = {'requests': 0, 'inflight': 0, 'rejected': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def invoke(self, event, wait):
+        '''
+        Вызывает handler, если у маршрута есть свободный слот. Медленная функция
+        выбирает только свой лимит и не забирает все потоки шлюза у остальных.
+        '''
+        if not self.slots.acquire(timeout=wait):
+            with self._lock:
+                self.stats['rejected'] += 1
+            return {
+                'statusCode': 503,
+                'headers': dict(JSON_HEADERS, **{'Retry-After': '1'}),
+                'body': json.dumps({'error': 'Сервис перегружен, повторите запрос позже'})
+            }
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['inflight'] += 1
+        try:
+            return self.handler(event, InvocationContext(self.name))
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+            traceback.print_exc()
+            return {
+                'statusCode': 500,
+                'headers': JSON_HEADERS,
+                'body': json.dumps({'error': 'Внутренняя ошибка сервера'})
+            }
+        finally:
+            with self._lock:
+                self.stats['inflight'] -= 1
+            self.slots.release()
+
+
+def load_functions(names):
+    '''
+    Импортирует index.py каждой функции с её каталогом первым в sys.path, как
+    платформа. Общие модули (db, http_client, tracing, ...) лежат в каталогах
+    функций одинаковыми копиями и импортируются один раз, поэтому пул
+    соединений с БД и HTTP-сессия у функций общие. Если копия в каком-то
+    каталоге разошлась с уже загруженной, шлюз не стартует.
+    '''
+    handlers = {}
+    for name in names:
+        function_dir = BACKEND_DIR / name
+        if not (function_dir / 'index.py').exists():
+            raise GatewayError(f'нет функции {name}: {function_dir}/index.py')
+
+        sys.path.insert(0, str(function_dir))
+        try:
+            spec = importlib.util.spec_from_file_location(f"index_{name.replace('-', '_')}", function_dir / 'index.py')
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(str(function_dir))
+
+        for path in function_dir.glob('*.py'):
+            loaded = sys.modules.get(path.stem)
+            if path.stem == 'index' or loaded is None or not getattr(loaded, '__file__', None):
+                continue
+            if _digest(path) != _digest(Path(loaded.__file__)):
+                raise GatewayError(f'{path} отличается от уже загруженного {loaded.__file__}')
+        handlers[name] = module.handler
+    return handlers
+
+
+def _digest(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    '''
+    /<функция>/<путь>?<query> -> event с httpMethod, path, headers,
+    queryStringParameters, body и requestContext.identity.sourceIp.
+    Соединение закрывается после ответа: keep-alive держал бы поток пула
+    на простаивающего клиента, его лучше отдать обратному прокси.
+    '''
+    disable_nagle_algorithm = True
+    server_version = 'gateway'
+
+    def _dispatch(self):
+        url = urlsplit(self.path)
+        name, _, subpath = url.path.lstrip('/').partition('/')
+
+        if name == 'healthz':
+            return self._reply({'statusCode': 200, 'headers': JSON_HEADERS,
+                                'body': json.dumps(self.server.health())})
+
+        route = self.server.routes.get(name)
+        if route is None:
+            return self._reply({'statusCode': 404, 'headers': JSON_HEADERS,
+                                'body': json.dumps({'error': 'Функция не найдена'})})
+
+        event = {
+            'httpMethod': self.command,
+            'path': '/' + subpath,
+            'headers': dict(self.headers.items()),
+            'queryStringParameters': {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()},
+            'isBase64Encoded': False,
+            'requestContext': {
+                'httpMethod': self.command,
+                'identity': {'sourceIp': self._client_ip()}
+            }
+        }
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            raw = self.rfile.read(length)
+            try:
+                event['body'] = raw.decode()
+            except UnicodeDecodeError:
+                event['body'] = base64.b64encode(raw).decode()
+                event['isBase64Encoded'] = True
+
+        self._reply(route.invoke(event, self.server.route_wait))
+
+    def _client_ip(self):
+        # За обратным прокси адрес клиента — первый в X-Forwarded-For, иначе все делят одну корзину лимитов
+        forwarded = self.headers.get('X-Forwarded-For')
+        if self.server.trust_forwarded and forwarded:
+            return forwarded.split(',')[0].strip()
+        return self.client_address[0]
+
+    def _reply(self, response):
+        response = response if isinstance(response, dict) else {'statusCode': 204}
+        body = response.get('body') or ''
+        if response.get('isBase64Encoded'):
+            payload = base64.b64decode(body)
+        else:
+            payload = body.encode() if isinstance(body, str) else body
+        self.send_response(int(response.get('statusCode', 200)))
+        for key, value in (response.get('headers') or {}).items():
+            self.send_header(key, str(value))
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = do_HEAD = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GatewayServer(HTTPServer):
+    '''
+    Принятые соединения обрабатывает пул из workers потоков. Ожидать потока
+    может не больше queue соединений — дальше цикл accept останавливается,
+    и новые клиенты ждут в очереди ядра, а не копятся в памяти процесса.
+    '''
+    allow_reuse_address = True
+
+    def __init__(self, address, routes, workers, queue, route_wait, trust_forwarded=False):
+        super().__init__(address, GatewayHandler)
+        self.routes = routes
+        self.route_wait = route_wait
+        self.trust_forwarded = trust_forwarded
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gateway')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self.executor.submit(self._process, request, client_address)
+        except RuntimeError:
+            # Пул уже останавливается — соединение закрывается без ответа
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def health(self):
+        health = {'status': 'ok', 'routes': {name: dict(route.stats, limit=route.limit)
+                                             for name, route in self.routes.items()}}
+        db = sys.modules.get('db')
+        if db is not None:
+            health['db'] = db.pool_stats()
+            if db.REPLICA_URL:
+                health['replica'] = db.replica_stats()
+        rate_limit = sys.modules.get('rate_limit')
+        if rate_limit is not None:
+            health['rate_limit'] = rate_limit.stats()
+        return health
+
+    def drain(self, grace):
+        '''Ждёт запросы в работе не дольше grace секунд; True, если все завершились.'''
+        done = threading.Event()
+        threading.Thread(target=lambda: (self.executor.shutdown(wait=True), done.set()), daemon=True).start()
+        return done.wait(grace)
+
+
+def run_timer(name, handler, interval, stop):
+    '''Вызывает функцию с событием таймера каждые interval секунд, как триггер платформы.'''
+    while not stop.wait(interval):
+        try:
+            handler({'event_type': 'timer'}, InvocationContext(name))
+        except Exception:
+            traceback.print_exc()
+
+
+def run_last_login_flusher(stop):
+    '''В режиме buffer сбрасывает last_login по сроку, даже если входов больше нет.'''
+    last_login = sys.modules.get('last_login')
+    while not stop.wait(1):
+        try:
+            last_login.flush_if_due()
+        except Exception:
+            traceback.print_exc()
+
+
+def parse_pairs(items, cast):
+    pairs = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        pairs[name.strip()] = cast(value)
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', '8080')))
+    parser.add_argument('--workers', type=int, default=32, help='потоков на обработку запросов')
+    parser.add_argument('--queue', type=int, default=64, help='принятых соединений, ожидающих поток')
+    parser.add_argument('--route-limit', action='append', default=[], help='функция=N одновременных вызовов')
+    parser.add_argument('--route-wait', type=float, default=1.0, help='секунд ожидания слота маршрута до 503')
+    parser.add_argument('--timer', action='append', default=[], help='функция=интервал в секундах')
+    parser.add_argument('--trust-forwarded', action='store_true', help='брать IP клиента из X-Forwarded-For')
+    parser.add_argument('--grace', type=float, default=30.0, help='секунд на завершение запросов при остановке')
+    args = parser.parse_args()
+
+    # Один пул соединений и одна HTTP-сессия на все функции — по размеру пула потоков
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.workers))
+    os.environ.setdefault('HTTP_POOL_SIZE', str(args.workers))
+    os.environ.setdefault('WARMUP_ON_START', 'true')
+
+    with open(BACKEND_DIR / 'func2url.json') as f:
+        http_functions = sorted(json.load(f))
+    timers = parse_pairs(args.timer, float)
+    limits = parse_pairs(args.route_limit, int)
+
+    try:
+        handlers = load_functions(http_functions + [name for name in timers if name not in http_functions])
+    except GatewayError as e:
+        parser.exit(1, f'gateway: {e}\n')
+
+    routes = {name: Route(name, handlers[name], limits.get(name, args.workers)) for name in http_functions}
+    server = GatewayServer((args.host, args.port), routes, args.workers, args.queue, args.route_wait,
+                           args.trust_forwarded)
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    threads = [threading.Thread(target=server.serve_forever, daemon=True)]
+    threads += [threading.Thread(target=run_timer, args=(name, handlers[name], interval, stop), daemon=True)
+                for name, interval in timers.items()]
+    last_login = sys.modules.get('last_login')
+    if last_login is not None and last_login.MODE == 'buffer':
+        threads.append(threading.Thread(target=run_last_login_flusher, args=(stop,), daemon=True))
+    for thread in threads:
+        thread.start()
+    print(json.dumps({'gateway': {'listening': f'{args.host}:{server.server_address[1]}',
+                                  'routes': {name: route.limit for name, route in routes.items()},
+                                  'timers': timers, 'workers': args.workers}}), flush=True)
+
+    while not stop.wait(1):
+        pass
+
+    # Новые соединения больше не принимаются, начатые запросы дорабатывают
+    started = time.monotonic()
+    server.shutdown()
+    drained = server.drain(args.grace)
+    server.server_close()
+    last_login = sys.modules.get('last_login')
+    if last_login is not None:
+        last_login.flush()
+    db = sys.modules.get('db')
+    if db is not None:
+        db.close_all()
+    print(json.dumps({'gateway': {'stopped': True, 'drained': drained,
+                                  'shutdown_ms': round((time.monotonic() - started) * 1000, 1)}}), flush=True)
+
+
+if __name__ == '__main__':
+    main()